@@ -15,12 +15,18 @@ class ArgsParser:
                                  help = 'select boot source')
 
         self.parser.add_argument('--port', required = False,
-                                 help = 'serial port to use')
+                                 help = 'serial port to use, sim://<name> '
+                                        'for simulated MCU')
 
         self.parser.add_argument('--baudrate', type = int,
                                  default = 500_000,
                                  help = 'serial port baudrate')
 
+        self.parser.add_argument('--loadbaudrate', type = int,
+                                 default = 2_000_000,
+                                 help = 'serial port baudrate used once eflash '
+                                        'loader is running, 0 disables switch')
+
         self.parser.add_argument('--xtal',
                                  help = 'MCU cristal oscilator frequency')
 
@@ -53,6 +59,63 @@ class ArgsParser:
         self.parser.add_argument('--bootpin', default = 'RTS',
                                  help = 'select signal connected to BOOT pin')
 
+        self.parser.add_argument('--boottime', type = float, default = 0.05,
+                                 help = 'time BOOT pin is held before and '
+                                        'after reset, in seconds')
+
+        self.parser.add_argument('--resettime', type = float, default = 0.05,
+                                 help = 'length of reset pulse on ENABLE pin, '
+                                        'in seconds')
+
+        self.parser.add_argument('--chunksize', type = int, default = 4096,
+                                 help = 'payload size of single flash write '
+                                        '(max 8000 bytes)')
+
+        self.parser.add_argument('--window', type = int, default = 1,
+                                 help = 'max number of unacknowledged flash '
+                                        'writes, 1 disables pipelining; '
+                                        'limited so that they fit into '
+                                        'eflash loader 16 KiB RX buffer '
+                                        '(3 with default chunk size)')
+
+        self.parser.add_argument('--incremental', action = 'store_true',
+                                 default = False,
+                                 help = 'write only sectors which differ from '
+                                        'flash content')
+
+        self.parser.add_argument('--chiperase', action = 'store_true',
+                                 default = False,
+                                 help = 'allow erasing whole chip if it is '
+                                        'faster than erasing image region')
+
+        self.parser.add_argument('--reuseloader', action = 'store_true',
+                                 default = False,
+                                 help = 'reuse eflash loader left running by '
+                                        'previous session instead of '
+                                        'resetting MCU')
+
+        self.parser.add_argument('--compress', action = 'store_true',
+                                 default = False,
+                                 help = 'send image XZ compressed, if eflash '
+                                        'loader supports it')
+
+        self.parser.add_argument('--ports', nargs = '+', default = [],
+                                 help = 'serial ports to flash in parallel')
+
+        self.parser.add_argument('--asyncio', action = 'store_true',
+                                 default = False,
+                                 help = 'drive all ports from single asyncio '
+                                        'event loop instead of threads')
+
+        self.parser.add_argument('--stats', action = 'store_true',
+                                 default = False,
+                                 help = 'print per-command statistics '
+                                        'when finished')
+
+        self.parser.add_argument('--statsfile',
+                                 help = 'write per-command statistics into '
+                                        'file in Prometheus text format')
+
 
     def parse_args(self):
         return self.parser.parse_args()
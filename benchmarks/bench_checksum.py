@@ -0,0 +1,46 @@
+"""Micro-benchmark of BLProtocol.calc_checksum.
+
+Compares current implementation with the old pure Python loop over typical
+command payload sizes.
+
+Usage:
+    python benchmarks/bench_checksum.py [--number 2000]
+
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bl_protocol import BLProtocol
+
+
+def loop_checksum(data):
+    """Checksum calculation from before sum() was used."""
+
+    sum = 0
+    for e in data:
+        sum = sum + e
+    return sum & 0xFF
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type = int, default = 2000)
+    args = parser.parse_args()
+
+    for size in (176, 2048, 4080, 4096, 8000):
+        data = os.urandom(size)
+        assert loop_checksum(data) == BLProtocol.calc_checksum(data)
+        for name, func in (('loop', loop_checksum),
+                           ('builtin', BLProtocol.calc_checksum)):
+            elapsed = timeit.timeit(lambda: func(data), number = args.number)
+            print(f"{size:5} B | {name:8} | "
+                  f"{elapsed / args.number * 1e6:8.2f} us per call")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Flash write throughput benchmark for different chunk sizes.
+
+Writes random data with flash_write_all using every given chunk size and
+reports achieved bytes per second. Device is put into eflash loader mode
+first. Content of flash at given address gets overwritten!
+
+Usage:
+    python benchmarks/bench_chunk_size.py --port /dev/ttyUSB0 \\
+        [--baudrate 500000] [--size 65536] [--chunks 1024 2048 4096 8000]
+
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bl_uart import BLUart
+from bl_protocol import BLProtocol
+from bl_flasher import BLFlasher
+import bl_url_handlers
+
+EFLASH_LOADER_PATH = 'chips/bl702/image/eflash_loader/eflash_loader_32m.bin'
+
+
+def measure(bl_proto, start_addr, data, chunk_size):
+    """Erase region and write data into it.
+
+    Returns:
+        float: Time spent on writing, in seconds.
+    """
+
+    bl_proto.flash_erase(start_addr, start_addr + len(data) - 1)
+    start = time.perf_counter()
+    bl_proto.flash_write_all(start_addr, data, chunk_size)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', required = True)
+    parser.add_argument('--baudrate', type = int, default = 500_000)
+    parser.add_argument('--addr', type = lambda x: int(x, 0), default = 0x2000)
+    parser.add_argument('--size', type = int, default = 64 * 1024)
+    parser.add_argument('--chunks', type = int, nargs = '+',
+                        default = [1024, 2048, 4096, 8000])
+    args = parser.parse_args()
+
+    bl_url_handlers.register()
+
+    data = os.urandom(args.size)
+
+    # Eflash loader is uploaded at safe baudrate, then link is switched
+    bl_uart = BLUart(port = args.port, baudrate = 500_000)
+    bl_proto = BLProtocol(bl_uart)
+    bl_flasher = BLFlasher(bl_uart, bl_proto)
+    try:
+        bl_flasher.prepare(EFLASH_LOADER_PATH, args.baudrate)
+        print(f"link running at {bl_uart.baudrate} baud")
+        print(f"image {args.size} bytes")
+        for chunk_size in args.chunks:
+            elapsed = measure(bl_proto, args.addr, data, chunk_size)
+            print(f"chunk {chunk_size:5} | {elapsed:7.3f} s"
+                  f" | {args.size / elapsed:10.0f} B/s")
+    finally:
+        bl_uart.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""End-to-end flashing benchmark with per-phase timing.
+
+Runs the whole flashing flow for every combination of load baudrate, chunk
+size and image, and measures each phase separately. By default it runs
+against simulated MCU (see bl_sim), pass real port to measure a fixture.
+Content of flash gets overwritten!
+
+Results are written as JSON, one entry per run:
+
+    {"image": ..., "image_size": ..., "baudrate": ..., "chunk_size": ...,
+     "link_baudrate": ..., "total_time": ...,
+     "phases": {"connect": {"time": ..., "bytes": ..., "bytes_per_s": ...},
+                ...}}
+
+Usage:
+    python benchmarks/bench_e2e.py [--port sim://bench] \\
+        [--baudrates 500000 2000000] [--chunks 2048 4096 8000] \\
+        [--images samples/*/project.bin] [--repeat 1] [--output out.json]
+
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import bl_errors
+from bl_uart import BLUart
+from bl_protocol import BLProtocol
+from bl_flasher import BLFlasher, load_efloader_image
+from bl_image import BLImage
+from bootinfo import BootInfo
+import bl_url_handlers
+
+EFLASH_LOADER_PATH = 'chips/bl702/image/eflash_loader/eflash_loader_32m.bin'
+BOOTINFO_PATH = 'utils/bootinfo.cfg'
+
+
+class PhaseTimer:
+    """Run flashing steps and collect their timing."""
+
+    def __init__(self):
+        self.phases = {}
+
+    def run(self, name, size, func, *args):
+        """Call func(*args) and record its time as given phase.
+
+        Args:
+            name (str): Phase name.
+            size (int): Amount of bytes processed by the phase, 0 if
+                throughput makes no sense for it.
+            func (callable): Phase body.
+
+        Returns:
+            Result of func.
+        """
+
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        self.phases[name] = {
+            'time' : elapsed,
+            'bytes' : size,
+            'bytes_per_s' : size / elapsed if size and elapsed > 0 else None,
+        }
+        return result
+
+
+def run_flow(args, image, baudrate, chunk_size):
+    """Flash image once, phase by phase.
+
+    Returns:
+        tuple: Phases (dict) and baudrate link ended up at.
+    """
+
+    bl_uart = BLUart(port = args.port, baudrate = args.baudrate)
+    bl_proto = BLProtocol(bl_uart)
+    bl_flasher = BLFlasher(bl_uart, bl_proto)
+    timer = PhaseTimer()
+
+    efl_image = load_efloader_image(EFLASH_LOADER_PATH)
+    efl_size = sum(len(part) for part in efl_image)
+    bin_size = len(image)
+    end_addr = args.addr + bin_size - 1
+
+    bootinfo = BootInfo(BOOTINFO_PATH)
+    bootinfo.set_img_len(bin_size)
+    bootheader = bootinfo.get_bytes()
+    bl_flasher.set_flash_cfg(bootinfo.bootheader.flash_cfg.cfg)
+
+    try:
+        if not timer.run('connect', 0, bl_flasher.connect, 2):
+            raise bl_errors.ConnectError("Bootloader is not responding")
+        timer.run('get_boot_info', 0, bl_proto.get_boot_info)
+        timer.run('flash_efloader', efl_size,
+                  bl_flasher.flash_efloader, EFLASH_LOADER_PATH)
+        timer.run('start_efloader', 0, bl_flasher.start_efloader)
+        if baudrate != bl_uart.baudrate:
+            timer.run('escalate_baudrate', 0,
+                      bl_flasher.escalate_baudrate, baudrate)
+        link_baudrate = bl_uart.baudrate
+
+        timer.run('flash_img_bootheader', len(bootheader),
+                  bl_flasher.flash_img_bootheader, bootheader)
+        timer.run('flash_erase', bin_size,
+                  bl_flasher.erase, args.addr, end_addr)
+        img_sha = timer.run('flash_write_all', bin_size,
+                            bl_proto.flash_write_all, args.addr, image.data,
+                            chunk_size, args.window)
+
+        def check_sha():
+            bl_proto.flash_write_check()
+            bl_proto.xip_read_start()
+            sha = bl_proto.flash_xip_readsha(args.addr, bin_size)
+            bl_proto.xip_read_finish()
+            bl_flasher.verify_sha(img_sha, sha)
+
+        timer.run('sha', bin_size, check_sha)
+    finally:
+        bl_uart.close()
+
+    return timer.phases, link_baudrate
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', default = 'sim://bench')
+    parser.add_argument('--baudrate', type = int, default = 500_000,
+                        help = 'baudrate used for eflash loader upload')
+    parser.add_argument('--baudrates', type = int, nargs = '+',
+                        default = [500_000, 2_000_000],
+                        help = 'baudrates used once eflash loader is running')
+    parser.add_argument('--chunks', type = int, nargs = '+',
+                        default = [2048, 4096, 8000])
+    parser.add_argument('--window', type = int, default = 1)
+    parser.add_argument('--images', nargs = '+',
+                        default = sorted(glob.glob('samples/*/project.bin')))
+    parser.add_argument('--addr', type = lambda x: int(x, 0), default = 0x2000)
+    parser.add_argument('--repeat', type = int, default = 1)
+    parser.add_argument('--output',
+                        help = 'JSON output file, stdout if not given')
+    args = parser.parse_args()
+
+    bl_url_handlers.register()
+
+    results = []
+    for image_path in args.images:
+        with BLImage(image_path) as image:
+            for baudrate in args.baudrates:
+                for chunk_size in args.chunks:
+                    for sample in range(args.repeat):
+                        phases, link_baudrate = run_flow(args, image,
+                                                         baudrate, chunk_size)
+                        total_time = sum(phase['time']
+                                         for phase in phases.values())
+                        results.append({
+                            'image' : image_path,
+                            'image_size' : len(image),
+                            'baudrate' : baudrate,
+                            'chunk_size' : chunk_size,
+                            'sample' : sample,
+                            'link_baudrate' : link_baudrate,
+                            'total_time' : total_time,
+                            'phases' : phases,
+                        })
+                        write_phase = phases['flash_write_all']
+                        print(f"{image_path} | {baudrate:8} baud"
+                              f" | chunk {chunk_size:5}"
+                              f" | total {total_time:7.3f} s"
+                              f" | write {write_phase['bytes_per_s']:10.0f} B/s",
+                              file = sys.stderr)
+
+    report = {
+        'port' : args.port,
+        'safe_baudrate' : args.baudrate,
+        'window' : args.window,
+        'python' : platform.python_version(),
+        'timestamp' : time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'results' : results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent = 2)
+    else:
+        json.dump(report, sys.stdout, indent = 2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
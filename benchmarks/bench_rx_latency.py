@@ -0,0 +1,82 @@
+"""Round-trip latency benchmark for BLUart RX path.
+
+Compares event driven RX thread with the old 20 ms polling loop. By default
+it runs against pyserial's loopback port, so every sent frame comes back as
+a "response". Pass real port with device echoing data to measure a real link.
+
+Usage:
+    python benchmarks/bench_rx_latency.py [--port loop://] [--count 200]
+
+"""
+
+import argparse
+import os
+import queue
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bl_uart import BLUart
+import bl_url_handlers
+
+
+class PollingBLUart(BLUart):
+    """BLUart with RX thread from before event driven reads."""
+
+    def _BLUart__rx_thread(self):
+        while self.uart.is_open and not self.stop_rx_thread:
+            time.sleep(0.02)
+            pending = self.uart.in_waiting
+            if pending > 0:
+                self.rx_callback(self.uart.read(pending))
+
+
+def measure(uart_class, port, baudrate, count, frame):
+    """Measure round trip of given frame.
+
+    Returns:
+        list: Round trip times in seconds.
+    """
+
+    rx_queue = queue.Queue()
+    bl_uart = uart_class(port = port, baudrate = baudrate)
+    bl_uart.register_rx_callback(rx_queue.put)
+
+    samples = []
+    try:
+        for _ in range(count):
+            start = time.perf_counter()
+            bl_uart.send_data(frame)
+            received = 0
+            while received < len(frame):
+                received += len(rx_queue.get(timeout = 2))
+            samples.append(time.perf_counter() - start)
+    finally:
+        bl_uart.close()
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', default = 'loop://')
+    parser.add_argument('--baudrate', type = int, default = 500_000)
+    parser.add_argument('--count', type = int, default = 200)
+    args = parser.parse_args()
+
+    bl_url_handlers.register()
+
+    # Typical flash_write response size
+    frame = b'OK'
+
+    for name, uart_class in (('polling', PollingBLUart), ('event', BLUart)):
+        samples = measure(uart_class, args.port, args.baudrate,
+                          args.count, frame)
+        print(f"{name:8} mean {statistics.mean(samples) * 1000:7.3f} ms"
+              f" | median {statistics.median(samples) * 1000:7.3f} ms"
+              f" | max {max(samples) * 1000:7.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
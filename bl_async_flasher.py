@@ -0,0 +1,340 @@
+"""This module contains AsyncBLFlasher class, asyncio counterpart of
+BLFlasher.
+
+Planning, verification and baudrate selection are shared with BLFlasher
+through BLFlasherBase, this class only runs the commands, so a single event
+loop can flash many MCUs the same way BLFlasher flashes one.
+
+Usage:
+    bl_uart = AsyncBLUart(port = '/dev/ttyUSB0')
+    bl_flasher = AsyncBLFlasher(bl_uart)
+    await bl_flasher.prepare(efl_path, load_baudrate = 2_000_000)
+    await bl_flasher.flash_firmware(image)
+
+"""
+
+import hashlib
+import logging
+
+import bl_errors
+from bl_async_protocol import AsyncBLProtocol
+from bl_flasher import (BLFlasherBase, EFLOADER_START_SEQUENCE,
+                        load_efloader_image)
+
+
+class AsyncBLFlasher(BLFlasherBase):
+    def __init__(self, bl_uart, bl_proto = None, progress = None):
+        """
+        Args:
+            bl_uart (AsyncBLUart): Connection with MCU.
+            bl_proto (AsyncBLProtocol): Protocol on top of bl_uart, None
+                creates a new one.
+            progress (callable): Called with Progress during eflash loader
+                upload, erase and write.
+        """
+
+        if bl_proto is None:
+            bl_proto = AsyncBLProtocol(bl_uart)
+        super().__init__(bl_uart, bl_proto, progress)
+
+    async def single_connect(self):
+        await self.bl_uart.enter_bootloader()
+        return await self.wait_ready()
+
+    async def wait_ready(self, max_time = 1.0):
+        """Probe MCU with handshakes until it responds.
+
+        Returns:
+            bool: True if MCU responded to handshake.
+        """
+
+        try:
+            stats = await self.bl_proto.handshake(max_time = max_time)
+        except bl_errors.InvalidResponseError:
+            return False
+        logging.debug(f"Ready after {stats.attempts} handshakes, "
+                      f"{stats.elapsed:.3f} s")
+        return True
+
+    async def connect(self, retries_amount = 3):
+        for attempt in range(retries_amount):
+            if attempt > 0 and self.bl_proto.stats is not None:
+                self.bl_proto.stats.retry('connect')
+            if await self.single_connect():
+                return True
+        return False
+
+    async def flash_efloader(self, efl_path):
+        efl_image = load_efloader_image(efl_path)
+        await self.bl_proto.load_boot_header(efl_image.boot_header)
+        await self.bl_proto.load_segment_header(efl_image.segment_header)
+        await self.bl_proto.load_full_data(efl_image.segment_data,
+                                           self.progress)
+        if await self.bl_proto.check_image() is True:
+            logging.info("Eflash loader has been loaded succesfully")
+
+    async def flash_img_bootheader(self, data, erase = True):
+        if erase:
+            await self.erase(0x0000, 0x00AF)
+        await self.bl_proto.flash_write(0x0000, data)
+        await self.bl_proto.flash_write_check()
+        await self.bl_proto.xip_read_start()
+        sha = await self.bl_proto.flash_xip_readsha(0x0000, len(data))
+        logging.info(f"FlashXipReadSha response: {sha}")
+        await self.bl_proto.xip_read_finish()
+        self.verify_sha(hashlib.sha256(data).digest(), sha)
+
+    async def probe_efloader(self, baudrates):
+        """Check if eflash loader is already running on MCU, see
+        BLFlasher.probe_efloader().
+
+        Returns:
+            bool: True if eflash loader responded, link is left at the
+                baudrate it responded at.
+        """
+
+        safe_baudrate = self.bl_uart.baudrate
+        for baudrate in baudrates:
+            self.bl_uart.set_baudrate(baudrate)
+            try:
+                await self.bl_proto.handshake(max_time = 0.1)
+                await self.bl_proto.read_jedecid()
+            except bl_errors.BLBootProtocolError:
+                continue
+            return True
+
+        self.bl_uart.set_baudrate(safe_baudrate)
+        return False
+
+    async def prepare(self, efl_path, load_baudrate = None, reuse = False):
+        """Connect to MCU and start eflash loader on it, see
+        BLFlasher.prepare().
+
+        Returns:
+            bytearray: Boot info reported by MCU's bootloader, None if
+                running eflash loader was reused.
+
+        Raises:
+            ConnectError: If bootloader did not respond to handshake.
+        """
+
+        if reuse:
+            if await self.probe_efloader(self.probe_baudrates(load_baudrate)):
+                logging.info("Eflash loader is already running, "
+                             "skipping upload")
+                # Loader may have been left at safe baudrate
+                if load_baudrate and load_baudrate != self.bl_uart.baudrate:
+                    try:
+                        await self.escalate_baudrate(load_baudrate)
+                    except bl_errors.ConnectError:
+                        logging.warning("Eflash loader lost at "
+                                        f"{load_baudrate} baud, starting over")
+                        return await self.prepare(efl_path)
+                return None
+
+        if not await self.connect(2):
+            raise bl_errors.ConnectError("Bootloader is not responding")
+        boot_info = await self.bl_proto.get_boot_info()
+        logging.debug(f"GetBootInfo response: {boot_info}")
+        await self.flash_efloader(efl_path)
+        await self.start_efloader()
+
+        if load_baudrate and load_baudrate != self.bl_uart.baudrate:
+            try:
+                await self.escalate_baudrate(load_baudrate)
+            except bl_errors.ConnectError:
+                logging.warning("Eflash loader lost at "
+                                f"{load_baudrate} baud, starting over")
+                return await self.prepare(efl_path)
+        return boot_info
+
+    async def start_efloader(self):
+        """Run uploaded eflash loader and wait until it responds.
+
+        Raises:
+            ConnectError: If eflash loader did not respond to handshake.
+        """
+
+        for data in EFLOADER_START_SEQUENCE:
+            await self.bl_proto.memory_write(data)
+
+        if not await self.wait_ready():
+            raise bl_errors.ConnectError("Eflash loader is not responding")
+
+    async def escalate_baudrate(self, baudrate, timeout = 0.5):
+        """Switch both host and eflash loader to given baudrate, see
+        BLFlasher.escalate_baudrate().
+
+        Returns:
+            bool: True if link runs at new baudrate, False if it stayed
+                at the old one.
+
+        Raises:
+            ConnectError: If eflash loader doesn't respond at any baudrate.
+        """
+
+        safe_baudrate = self.bl_uart.baudrate
+        try:
+            await self.bl_proto.change_rate(safe_baudrate, baudrate)
+        except bl_errors.BLBootProtocolError as e:
+            logging.warning(f"Baudrate change rejected: {e!r}")
+            return False
+
+        self.bl_uart.set_baudrate(baudrate)
+        try:
+            await self.bl_proto.handshake(max_time = timeout)
+        except bl_errors.BLBootProtocolError:
+            logging.warning(f"No handshake at {baudrate} baud, "
+                            f"falling back to {safe_baudrate}")
+        else:
+            logging.info(f"Switched to {baudrate} baud")
+            return True
+
+        # Eflash loader may still be listening at old baudrate
+        self.bl_uart.set_baudrate(safe_baudrate)
+        try:
+            await self.bl_proto.handshake(max_time = timeout)
+        except bl_errors.BLBootProtocolError:
+            raise bl_errors.ConnectError("Eflash loader is not responding")
+        return False
+
+    async def read_device_info(self):
+        """Read MAC address and flash JEDEC ID through eflash loader.
+
+        Returns:
+            tuple: MAC address and JEDEC ID, both as bytearray.
+        """
+
+        mac_addr = await self.bl_proto.efuse_read_mac_addr()
+        logging.info(f"EfuseReadMacAddr response: {mac_addr}")
+        jedecid = await self.bl_proto.read_jedecid()
+        logging.info(f"ReadJededId response: {jedecid}")
+        return mac_addr, jedecid
+
+    async def erase(self, start_addr, end_addr, allow_chip_erase = False):
+        """Erase flash region with the cheapest mix of erase commands, see
+        BLFlasher.erase().
+
+        Returns:
+            float: Predicted erase time in seconds, None if unknown.
+        """
+
+        if self.erase_planner is None:
+            await self.bl_proto.flash_erase(start_addr, end_addr,
+                                            progress = self.progress)
+            return None
+
+        steps, predicted_time = self.erase_steps(start_addr, end_addr,
+                                                 allow_chip_erase)
+        for step, timeout, step_progress in steps:
+            if step.kind == 'chip':
+                await self.bl_proto.flash_chip_erase(timeout)
+                continue
+            await self.bl_proto.flash_erase(step.start_addr, step.end_addr,
+                                            timeout, step_progress, step.time)
+        return predicted_time
+
+    async def flash_firmware(self, image, start_addr = 0x2000,
+                             bootinfo_path = 'utils/bootinfo.cfg',
+                             chunk_size = 4096, window = 1,
+                             incremental = False, chip_erase = False,
+                             compress = False):
+        """Write firmware image with its bootheader into MCU's flash, see
+        BLFlasher.flash_firmware().
+
+        Returns:
+            bytearray: SHA of written region reported by MCU.
+
+        Raises:
+            VerifyError: If SHA reported by MCU doesn't match the image.
+        """
+
+        bin_size = len(image)
+        end_addr = start_addr + bin_size - 1
+
+        plan = self.plan_firmware(image, start_addr, bootinfo_path,
+                                  incremental, chip_erase)
+        if plan.chip_erase:
+            await self.erase(start_addr, end_addr, True)
+
+        await self.flash_img_bootheader(plan.bootinfo.get_bytes(),
+                                        erase = not plan.chip_erase)
+
+        if plan.incremental:
+            await self.flash_changed_sectors(start_addr, image.data,
+                                             plan.sector_size, chunk_size,
+                                             window)
+            img_sha = hashlib.sha256(image.data).digest()
+        else:
+            logging.info(f"Binary size: {bin_size}, start {start_addr}, "
+                         f"end {end_addr}")
+            if not plan.chip_erase:
+                await self.erase(start_addr, end_addr)
+
+            img_sha = None
+            if compress:
+                img_sha = await self.write_compressed(start_addr, image.data,
+                                                      chunk_size, window)
+            if img_sha is None:
+                img_sha = await self.bl_proto.flash_write_all(
+                    start_addr, image.data, chunk_size, window,
+                    progress = self.progress)
+
+        await self.bl_proto.flash_write_check()
+        await self.bl_proto.xip_read_start()
+        sha = await self.bl_proto.flash_xip_readsha(start_addr, bin_size)
+        logging.info(f"FlashXipReadSha response: {sha}")
+        await self.bl_proto.xip_read_finish()
+
+        self.verify_sha(img_sha, sha)
+        return sha
+
+    async def write_compressed(self, start_addr, data, chunk_size = 4096,
+                               window = 1):
+        """Write erased region with compressed data.
+
+        Returns:
+            bytes: SHA-256 digest of written data or None if eflash loader
+                doesn't support compressed writes.
+        """
+
+        try:
+            return await self.bl_proto.flash_decompress_write_all(
+                start_addr, data, chunk_size, window, self.progress)
+        except bl_errors.IdError:
+            logging.warning("Compressed write not supported by eflash loader, "
+                            "falling back to plain write")
+            return None
+
+    async def find_changed_sectors(self, start_addr, image, sector_size):
+        """Compare image with flash content sector by sector.
+
+        Returns:
+            list: Offsets (relative to image start) of sectors which differ.
+        """
+
+        changed = []
+        await self.bl_proto.xip_read_start()
+        for offset in range(0, len(image), sector_size):
+            block = image[offset:offset + sector_size]
+            device_sha = await self.bl_proto.flash_xip_readsha(
+                start_addr + offset, len(block))
+            if device_sha != hashlib.sha256(block).digest():
+                changed.append(offset)
+        await self.bl_proto.xip_read_finish()
+        return changed
+
+    async def flash_changed_sectors(self, start_addr, image, sector_size,
+                                    chunk_size = 4096, window = 1):
+        """Erase and write only sectors which content differs from image."""
+
+        changed = await self.find_changed_sectors(start_addr, image,
+                                                  sector_size)
+        for run_start, run_end in self.changed_runs(changed, len(image),
+                                                    sector_size):
+            data = image[run_start:run_end]
+            await self.erase(start_addr + run_start,
+                             start_addr + run_start + len(data) - 1)
+            await self.bl_proto.flash_write_all(start_addr + run_start, data,
+                                                chunk_size, window,
+                                                progress = self.progress)
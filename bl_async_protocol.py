@@ -0,0 +1,348 @@
+"""This module contains AsyncBLProtocol class, asyncio counterpart of
+BLProtocol.
+
+Commands are coroutines, so single event loop can drive many MCUs and wait
+for response of one while sending to another. Command tables, frame building,
+statistics, handshake retries and pipelined write state are shared with
+BLProtocol (see BLProtocolBase and BLWritePipeline), this class only does
+the I/O.
+
+Usage:
+    bl_uart = AsyncBLUart(port = '/dev/ttyUSB0')
+    bl_proto = AsyncBLProtocol(bl_uart)
+    await bl_uart.enter_bootloader()
+    await bl_proto.handshake(max_time = 1.0)
+    boot_info = await bl_proto.get_boot_info()
+
+"""
+
+import asyncio
+import logging
+import time
+
+import bl_errors
+from bl_frame import BLFrameDecoder
+from bl_progress import ProgressMeter
+from bl_protocol import BLProtocolBase, BLWritePipeline
+
+
+class AsyncBLProtocol(BLProtocolBase):
+    def __init__(self, interface, stats = None):
+        """
+        Args:
+            interface (AsyncBLUart): Connection with MCU.
+            stats (BLStats): Collects per-command statistics, None disables
+                them.
+        """
+
+        super().__init__(interface, stats)
+        self.rx_queue = asyncio.Queue()
+        self.rx_decoder = BLFrameDecoder()
+
+        self.interface.register_rx_callback(self.rx_callback_handler)
+
+    def rx_callback_handler(self, data):
+        for frame in self.rx_decoder.feed(data):
+            self.rx_queue.put_nowait(frame)
+
+    def flush_rx(self):
+        """Drop all received data and responses nobody waits for."""
+
+        self.rx_decoder.reset()
+        while not self.rx_queue.empty():
+            self.rx_queue.get_nowait()
+        self.stats_in_flight.clear()
+
+    async def get_response(self, timeout = None):
+        """Get next response frame.
+
+        Args:
+            timeout (float): Max waiting time for response, given in seconds.
+                None means wait forever.
+
+        Returns:
+            bytes: Response frame.
+
+        Raises:
+            ResponseTimeoutError: If no response came in time.
+        """
+
+        try:
+            response = await asyncio.wait_for(self.rx_queue.get(), timeout)
+        except asyncio.TimeoutError:
+            self.record_timeout()
+            raise bl_errors.ResponseTimeoutError(
+                f"No response within {timeout:.3f} s") from None
+        self.record_response(response)
+        return response
+
+    async def get_final_response(self, deadline):
+        """Get next response, skipping PD responses.
+
+        Args:
+            deadline (float): Time on monotonic clock the final response
+                has to come before.
+
+        Returns:
+            bytes: Response frame.
+        """
+
+        response = await self.get_response(max(0, deadline - time.monotonic()))
+        while response[0:2] == b'PD':
+            logging.debug("Pending...")
+            response = await self.get_response(
+                max(0, deadline - time.monotonic()))
+        return response
+
+    async def send_command(self, data, with_payload = False):
+        """Send data to MCU without waiting for its response.
+
+        Args:
+            data (bytes-like): Data to sent.
+            with_payload (bool): True if OK response carries payload.
+        """
+
+        self.rx_decoder.expect(with_payload)
+        self.record_command(data)
+        await self.interface.send_data(data)
+
+    async def send_data_wait_for_response(self, data, timeout = None,
+                                          with_payload = False):
+        """Send data to MCU and wait for its response.
+
+        Args:
+            data (bytes-like): Data to sent.
+            timeout (float): Max waiting time for data, given in seconds.
+                None means default timeout of the command.
+            with_payload (bool): True if OK response carries payload.
+
+        Returns:
+            bytes: Response frame received from MCU.
+        """
+
+        if timeout is None:
+            timeout = (self.cmd_timeout[self.cmd_name[data[0]]]
+                       + self.transfer_time(len(data)))
+        await self.send_command(data, with_payload)
+        return await self.get_response(timeout)
+
+    async def __simple_command(self, name, data = b'', checksum = False,
+                               with_payload = False, timeout = None):
+        """Send command and check its response.
+
+        Returns:
+            bytes: Payload if with_payload is set, otherwise True.
+        """
+
+        logging.debug("%s command", name)
+        command = self.build_command(name, data, checksum)
+        response = await self.send_data_wait_for_response(command, timeout,
+                                                          with_payload)
+        self.is_response_ok(response)
+        if with_payload:
+            return self.get_payload(response)
+        return True
+
+    async def handshake(self, timeout = None, max_time = 0,
+                        burst_time = 0.002):
+        """Perform handshake with MCU's bootloader, see BLProtocol.handshake().
+
+        Returns:
+            HandshakeStats: Amount of attempts and time spent on sync.
+
+        Raises:
+            InvalidResponseError: If MCU didn't respond in time.
+        """
+
+        retry = self.handshake_retry(timeout, max_time)
+        command = self.handshake_burst(burst_time)
+        for wait in retry:
+            self.flush_rx()
+            await self.send_command(command)
+            try:
+                if (await self.get_response(wait))[0:2] == b'OK':
+                    return self.handshake_done(retry, True)
+            except bl_errors.ResponseTimeoutError:
+                pass
+        return self.handshake_done(retry, False)
+
+    async def change_rate(self, old_baudrate, new_baudrate):
+        data = (old_baudrate.to_bytes(4, 'little')
+                + new_baudrate.to_bytes(4, 'little'))
+        return await self.__simple_command('change_rate', data, checksum = True)
+
+    async def get_boot_info(self):
+        return await self.__simple_command('get_boot_info',
+                                           with_payload = True)
+
+    async def load_boot_header(self, boot_header):
+        # boot_header is always 176 bytes long
+        if len(boot_header) != 176:
+            raise bl_errors.InvalidResponseError()
+        return await self.__simple_command('load_boot_header', boot_header)
+
+    async def load_segment_header(self, segment_header):
+        # Segment_header is always 16 bytes long
+        if len(segment_header) != 16:
+            raise bl_errors.InvalidResponseError()
+        return await self.__simple_command('load_segment_header',
+                                           segment_header,
+                                           with_payload = True)
+
+    async def load_segment_data(self, segment_data):
+        if len(segment_data) > 4096:
+            raise ValueError("Segment_data can't be longer than 4096 bytes")
+        return await self.__simple_command('load_segment_data', segment_data)
+
+    async def check_image(self):
+        return await self.__simple_command('check_image')
+
+    async def memory_write(self, unknown):
+        # Not waiting for response, same as BLProtocol
+        logging.debug("mem_write command")
+        command = self.build_command('mem_write', unknown)
+        self.record_command(command, with_response = False)
+        await self.interface.send_data(command)
+
+    async def read_jedecid(self):
+        return await self.__simple_command('read_jedecid', with_payload = True)
+
+    async def flash_erase(self, start_addr, end_addr, timeout = None,
+                          progress = None, expected_time = None):
+        """Erase MCU's flash memory region, see BLProtocol.flash_erase()."""
+
+        logging.debug("flash_erase command")
+        if timeout is None:
+            timeout = self.erase_timeout(start_addr, end_addr)
+        if expected_time is None:
+            expected_time = self.erase_time(start_addr, end_addr)
+        meter = None
+        if progress is not None:
+            meter = ProgressMeter(progress, 'erase', end_addr - start_addr + 1)
+        return await self.__wait_erase(
+            self.build_flash_erase(start_addr, end_addr), timeout, meter,
+            expected_time)
+
+    async def flash_chip_erase(self, timeout):
+        logging.debug("flash_chip_erase command")
+        return await self.__wait_erase(self.build_command('flash_chip_erase'),
+                                       timeout)
+
+    async def __wait_erase(self, command, timeout, meter = None,
+                           expected_time = 0):
+        # PD responses don't extend the deadline of whole erase
+        start = time.monotonic()
+        deadline = start + timeout
+        await self.send_command(command)
+        response = await self.get_response(max(0, deadline - time.monotonic()))
+        while response[0:2] == b'PD':
+            logging.debug("Pending...")
+            self.report_erase_progress(meter, time.monotonic() - start,
+                                       expected_time)
+            response = await self.get_response(
+                max(0, deadline - time.monotonic()))
+        result = self.is_response_ok(response)
+        if meter is not None:
+            meter.update(meter.total)
+        return result
+
+    async def flash_write(self, start_addr, payload):
+        if len(payload) > 8000:
+            raise ValueError("Payload can't be longer than 8000 bytes")
+        return await self.__simple_command(
+            'flash_write', start_addr.to_bytes(4, 'little') + bytes(payload),
+            checksum = True, timeout = self.write_timeout(len(payload)))
+
+    async def flash_write_check(self):
+        return await self.__simple_command('flash_write_check')
+
+    async def xip_read_start(self):
+        return await self.__simple_command('xip_read_start')
+
+    async def flash_xip_readsha(self, start_addr, length):
+        data = start_addr.to_bytes(4, 'little') + length.to_bytes(4, 'little')
+        return await self.__simple_command('flash_xip_readsha', data,
+                                           checksum = True,
+                                           with_payload = True)
+
+    async def xip_read_finish(self):
+        return await self.__simple_command('xip_read_finish')
+
+    async def efuse_read_mac_addr(self):
+        return await self.__simple_command('efuse_read_mac_addr',
+                                           with_payload = True)
+
+    async def load_full_data(self, data, progress = None):
+        """Send data to MCU split into "load_segment_data" commands.
+
+        Args:
+            data (bytes-like): Data to send, e.g. slice of BLImage.
+            progress (callable): Called with Progress after every chunk.
+        """
+
+        view = memoryview(data)
+        meter = None
+        if progress is not None:
+            meter = ProgressMeter(progress, 'load', len(view))
+        for offset in range(0, len(view), 4080):
+            chunk = view[offset:offset + 4080]
+            await self.load_segment_data(chunk)
+            if meter is not None:
+                meter.update(offset + len(chunk))
+
+    async def flash_write_all(self, start_addr, data, chunk_size = 4096,
+                              window = 1, skip_erased = True, progress = None):
+        """Write data into MCU's flash memory, see
+        BLProtocol.flash_write_all().
+
+        Returns:
+            bytes: SHA-256 digest of written data.
+        """
+
+        logging.debug("FlashWriteFull Procedure")
+        pipeline = BLWritePipeline(self, chunk_size, window, progress,
+                                   len(data))
+        return await self.__run_pipeline(
+            pipeline, pipeline.write(start_addr, data, skip_erased))
+
+    async def flash_decompress_write_all(self, start_addr, data,
+                                         chunk_size = 4096, window = 1,
+                                         progress = None):
+        """Write data into MCU's flash memory in XZ compressed form, see
+        BLProtocol.flash_decompress_write_all().
+
+        Returns:
+            bytes: SHA-256 digest of uncompressed data.
+        """
+
+        logging.debug("FlashDecompressWriteFull Procedure")
+        pipeline = BLWritePipeline(self, chunk_size, window, progress,
+                                   len(data))
+        return await self.__run_pipeline(
+            pipeline, pipeline.decompress_write(start_addr, data))
+
+    async def __run_pipeline(self, pipeline, commands):
+        try:
+            for command in commands:
+                await self.send_command(command)
+                while pipeline.full():
+                    await self.__acknowledge(pipeline)
+            while pipeline.in_flight:
+                await self.__acknowledge(pipeline)
+        except bl_errors.ResponseTimeoutError:
+            pipeline.fail()
+            raise
+        except bl_errors.BLBootProtocolError:
+            # Keep RX stream in sync, same as BLProtocol
+            for timeout in pipeline.fail():
+                try:
+                    await self.get_final_response(time.monotonic() + timeout)
+                except bl_errors.ResponseTimeoutError:
+                    break
+            raise
+        return pipeline.finish()
+
+    async def __acknowledge(self, pipeline):
+        response = await self.get_final_response(time.monotonic()
+                                                 + pipeline.timeout())
+        pipeline.acknowledge(response)
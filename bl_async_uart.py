@@ -0,0 +1,149 @@
+"""This module contains AsyncBLUart class, asyncio counterpart of BLUart.
+
+Port setup and pins are shared with BLUart through BLUartBase. Received data
+is handled by event loop reader of serial port's file descriptor, so no
+thread is needed per port. Ports without file descriptor (e.g. simulated
+sim:// ports or pyserial's loop://) are read in default executor instead.
+
+AsyncBLUart has to be created inside running event loop.
+
+"""
+
+import asyncio
+import io
+import logging
+import os
+
+import serial
+
+from bl_uart import BLUartBase
+
+
+class AsyncBLUart(BLUartBase):
+    def __init__(self,
+                 port = '/dev/ttyUSB0',
+                 baudrate = 500_000,
+                 boot_pin = 'RTS',
+                 boot_pin_inverted = True,
+                 en_pin = 'DTR',
+                 en_pin_inverted = True,
+                 boot_time = 0.05,
+                 reset_time = 0.05):
+
+        self.loop = asyncio.get_running_loop()
+
+        # Non-blocking port, reads never wait for data
+        super().__init__(port, baudrate, boot_pin, boot_pin_inverted, en_pin,
+                         en_pin_inverted, boot_time, reset_time, timeout = 0)
+        try:
+            self.fd = self.uart.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            self.fd = None
+        if self.fd is None:
+            # Blocking reads in executor, timeout only bounds how long they
+            # stay blocked after port is closed
+            self.uart.timeout = 0.1
+        self.rx_task = None
+
+    async def send_data(self, data):
+        """Send data over UART.
+
+        Returns when all data is handed to OS, without blocking event loop.
+
+        Args:
+            data (bytes-like): Data to sent.
+        """
+
+        if self.fd is None:
+            self.uart.write(data)
+            return
+
+        view = memoryview(data)
+        while len(view) > 0:
+            try:
+                written = os.write(self.fd, view)
+            except BlockingIOError:
+                written = 0
+            view = view[written:]
+            if len(view) > 0:
+                await self.__writable()
+
+    async def __writable(self):
+        writable = self.loop.create_future()
+        self.loop.add_writer(self.fd, writable.set_result, None)
+        try:
+            await writable
+        finally:
+            self.loop.remove_writer(self.fd)
+
+    def __on_readable(self):
+        try:
+            data = self.uart.read(self.uart.in_waiting or 1)
+        except serial.SerialException as e:
+            # E.g. adapter unplugged, responses will time out
+            logging.error(f"Reading from port failed: {e!r}")
+            self.loop.remove_reader(self.fd)
+            return
+        if data:
+            self.rx_callback(data)
+
+    async def __rx_task(self):
+        while self.uart.is_open:
+            try:
+                data = await self.loop.run_in_executor(None, self.uart.read, 1)
+            except serial.SerialException:
+                break
+            if not data:
+                continue
+            pending = self.uart.in_waiting
+            if pending > 0:
+                data += self.uart.read(pending)
+            self.rx_callback(data)
+
+    def register_rx_callback(self, rx_callback):
+        """Register function called with every chunk of received data.
+
+        Callback is run by event loop, reading starts with first registered
+        callback.
+
+        Args:
+            rx_callback (callable): Function taking received bytes.
+        """
+
+        first = self.rx_callback is None
+        self.rx_callback = rx_callback
+        if not first:
+            return
+        if self.fd is not None:
+            self.loop.add_reader(self.fd, self.__on_readable)
+        else:
+            self.rx_task = self.loop.create_task(self.__rx_task())
+
+    async def enter_bootloader(self):
+        """Put MCU into bootloader mode.
+
+        BOOT pin is held for boot_time before and after reset, readiness
+        of bootloader has to be checked with handshake.
+        """
+
+        logging.info("Entering bootloader.")
+        self.boot_pin_set(True)
+        await asyncio.sleep(self.boot_time)
+        await self.reset()
+        await asyncio.sleep(self.boot_time)
+        self.boot_pin_set(False)
+
+    async def reset(self):
+        """Pull ENABLE pin low for reset_time."""
+
+        self.en_pin_set(False)
+        await asyncio.sleep(self.reset_time)
+        self.en_pin_set(True)
+
+    async def close(self):
+        if self.rx_callback is not None and self.fd is not None:
+            self.loop.remove_reader(self.fd)
+        self.uart.close()
+        if self.rx_task is not None:
+            await self.rx_task
+            self.rx_task = None
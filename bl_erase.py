@@ -0,0 +1,82 @@
+"""This module contains BLErasePlanner class, which splits flash region into
+the cheapest sequence of sector/block erase commands.
+
+Erase times are taken from SpiFlashCfg (given there in milliseconds). Every
+step of the plan is aligned to its own size, so MCU erases it with a single
+flash command.
+
+"""
+
+import collections
+
+EraseStep = collections.namedtuple('EraseStep',
+                                   ['start_addr', 'end_addr', 'kind', 'time'])
+
+
+class BLErasePlanner:
+    def __init__(self, flash_cfg):
+        """
+        Args:
+            flash_cfg (SpiFlashCfg): Flash configuration from bootheader.
+        """
+
+        # sector_size is given in KB
+        self.sector_size = flash_cfg.sector_size * 1024
+        self.chip_erase_time = flash_cfg.chip_erase_time / 1000
+
+        # (name, size, time) of erase granularities, biggest first
+        self.granularities = [
+            ('block64K', 64 * 1024, flash_cfg.block64K_erase_time / 1000),
+            ('block32K', 32 * 1024, flash_cfg.block32K_erase_time / 1000),
+            ('sector', self.sector_size, flash_cfg.sector_erase_time / 1000),
+        ]
+
+    def plan(self, start_addr, end_addr, allow_chip_erase = False):
+        """Plan erase of given region.
+
+        Region is extended to whole sectors, as flash can't erase less.
+
+        Args:
+            start_addr (int): Starting address for memory erasing.
+            end_addr (int): Ending address for memory erasing (inclusive).
+            allow_chip_erase (bool): Allow erasing whole chip if it's faster.
+
+        Returns:
+            tuple: List of EraseStep and predicted total time in seconds.
+        """
+
+        first = start_addr // self.sector_size
+        last = end_addr // self.sector_size + 1
+        sectors = last - first
+
+        # cost[i] - cheapest time of erasing sectors first..first+i,
+        # choice[i] - granularity of the last step in that solution
+        cost = [0.0] + [float('inf')] * sectors
+        choice = [None] * (sectors + 1)
+        for i in range(1, sectors + 1):
+            for granularity in self.granularities:
+                _, size, time = granularity
+                span = size // self.sector_size
+                if span > i:
+                    continue
+                if ((first + i - span) * self.sector_size) % size != 0:
+                    continue
+                if cost[i - span] + time < cost[i]:
+                    cost[i] = cost[i - span] + time
+                    choice[i] = granularity
+
+        total_time = cost[sectors]
+        if allow_chip_erase and self.chip_erase_time < total_time:
+            return [EraseStep(None, None, 'chip', self.chip_erase_time)], \
+                   self.chip_erase_time
+
+        steps = []
+        i = sectors
+        while i > 0:
+            kind, size, time = choice[i]
+            i -= size // self.sector_size
+            step_start = (first + i) * self.sector_size
+            steps.append(EraseStep(step_start, step_start + size - 1,
+                                   kind, time))
+        steps.reverse()
+        return steps, total_time
@@ -11,6 +11,15 @@ class BLBootProtocolError(Exception):
 class InvalidResponseError(BLBootProtocolError):
     pass
 
+class ResponseTimeoutError(BLBootProtocolError):
+    pass
+
+class ConnectError(BLBootProtocolError):
+    pass
+
+class VerifyError(BLBootProtocolError):
+    pass
+
 # Flash errors
 ################################################################################
 class FlashError(BLBootProtocolError):
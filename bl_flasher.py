@@ -1,54 +1,602 @@
+import hashlib
 import logging
+import functools
+import collections
 import bl_errors
-import bootinfo
+from bootinfo import BootInfo
+from bl_image import BLImage
+from bl_erase import BLErasePlanner
+from bl_progress import ProgressMeter
 from bl_protocol import BLProtocol
 from bl_uart import BLUart
 from args_parser import ArgsParser
 
-class BLFlasher:
-    def __init__(self, bl_uart):
-        self.__bl_uart = bl_uart
-        self.__bl_proto = BLProtocol(bl_uart)
+# "memory_write" data which starts uploaded eflash loader
+EFLOADER_START_SEQUENCE = [
+    b'\x00\xf1\x00\x40\x45\x48\x42\x4e',
+    b'\x04\xf1\x00\x40\x00\x00\x01\x22',
+    b'\x18\x00\x00\x40\x00\x00\x00\x00',
+    b'\x18\x00\x00\x40\x02\x00\x00\x00',
+]
+
+EflashLoaderImage = collections.namedtuple(
+    'EflashLoaderImage', ['boot_header', 'segment_header', 'segment_data'])
+
+FirmwarePlan = collections.namedtuple(
+    'FirmwarePlan', ['bootinfo', 'sector_size', 'incremental', 'chip_erase'])
+
+@functools.lru_cache(maxsize = None)
+def load_efloader_image(efl_path):
+    """Map and split eflash loader image.
+
+    Result is cached, so all devices flashed by the process share one copy.
+
+    Args:
+        efl_path (str): Path to eflash loader image.
+
+    Returns:
+        EflashLoaderImage: Parts of the image, as memoryviews.
+    """
+
+    data = BLImage(efl_path).data
+    return EflashLoaderImage(data[:176], data[176:192], data[192:])
+
+class BLFlasherBase:
+    """I/O independent part of flashing procedure: planning, verification
+    and baudrate selection. Shared by BLFlasher and AsyncBLFlasher, which
+    run the commands.
+    """
+
+    def __init__(self, bl_uart, bl_proto, progress = None):
+        """
+        Args:
+            bl_uart (BLUartBase): Connection with MCU.
+            bl_proto (BLProtocolBase): Protocol on top of bl_uart.
+            progress (callable): Called with Progress during eflash loader
+                upload, erase and write.
+        """
+
+        self.bl_uart = bl_uart
+        self.bl_proto = bl_proto
+        self.progress = progress
+        self.erase_planner = None
+
+    @staticmethod
+    def verify_sha(expected, actual):
+        """Compare SHA of sent data with SHA reported by MCU.
+
+        Args:
+            expected (bytes): SHA-256 digest calculated on host.
+            actual (bytes): SHA-256 digest reported by MCU.
+
+        Raises:
+            VerifyError: If digests differ.
+        """
+
+        if expected != actual:
+            raise bl_errors.VerifyError(
+                f"SHA mismatch, expected {expected.hex()}, "
+                f"MCU reported {actual.hex() if actual else None}")
+
+    def probe_baudrates(self, load_baudrate):
+        """Get baudrates running eflash loader is probed at, in order.
+
+        Args:
+            load_baudrate (int): Baudrate used once eflash loader is running.
+
+        Returns:
+            list: Baudrates to probe.
+        """
+
+        baudrates = [self.bl_uart.baudrate]
+        if load_baudrate and load_baudrate != self.bl_uart.baudrate:
+            # Previous session most likely ended at load baudrate
+            baudrates.insert(0, load_baudrate)
+        return baudrates
+
+    def set_flash_cfg(self, flash_cfg):
+        """Use flash configuration for erase planning and timeouts.
+
+        Args:
+            flash_cfg (SpiFlashCfg): Flash configuration from bootheader.
+        """
+
+        self.erase_planner = BLErasePlanner(flash_cfg)
+        self.bl_proto.set_flash_timing(flash_cfg)
+
+    def plan_firmware(self, image, start_addr, bootinfo_path, incremental,
+                      chip_erase):
+        """Load bootheader configuration and decide how image is flashed.
+
+        Args:
+            image (BLImage): Firmware image.
+            start_addr (int): Flash address of the image.
+            bootinfo_path (str): Path to bootheader configuration.
+            incremental (bool): Incremental flashing was requested.
+            chip_erase (bool): Chip erase is allowed.
+
+        Returns:
+            FirmwarePlan: Bootheader, sector size, whether flashing is
+                incremental and whether whole chip is erased first.
+        """
+
+        bin_size = len(image)
+        end_addr = start_addr + bin_size - 1
+
+        bootinfo = BootInfo(bootinfo_path)
+        bootinfo.set_img_len(bin_size)
+        flash_cfg = bootinfo.bootheader.flash_cfg.cfg
+        self.set_flash_cfg(flash_cfg)
+
+        # sector_size is given in KB
+        sector_size = flash_cfg.sector_size * 1024
+        if incremental and start_addr % sector_size != 0:
+            logging.warning("Image is not sector aligned, "
+                            "falling back to full flashing")
+            incremental = False
+
+        # Chip erase would wipe bootheader too, so it has to go first
+        chip_erased = False
+        if chip_erase and not incremental:
+            steps, _ = self.erase_planner.plan(start_addr, end_addr, True)
+            chip_erased = steps[0].kind == 'chip'
+        return FirmwarePlan(bootinfo, sector_size, incremental, chip_erased)
+
+    def erase_steps(self, start_addr, end_addr, allow_chip_erase = False):
+        """Plan erase of flash region, see BLFlasher.erase().
+
+        Returns:
+            tuple: Steps, as tuples of EraseStep, its timeout and progress
+                callback (None without progress), and predicted erase time.
+        """
+
+        steps, predicted_time = self.erase_planner.plan(start_addr, end_addr,
+                                                        allow_chip_erase)
+        logging.info(f"Erasing in {len(steps)} steps, "
+                     f"predicted time {predicted_time:.2f} s")
+
+        # Progress of each step is reported as part of whole plan
+        meter = None
+        if self.progress is not None and steps[0].kind != 'chip':
+            meter = ProgressMeter(self.progress, 'erase',
+                                  steps[-1].end_addr + 1 - steps[0].start_addr)
+
+        planned = []
+        for step in steps:
+            timeout = (self.bl_proto.cmd_timeout['flash_erase']
+                       + 2 * step.time)
+            step_progress = None
+            if meter is not None:
+                done = step.start_addr - steps[0].start_addr
+                step_progress = (lambda progress, done = done:
+                                 meter.update(done + progress.done))
+            planned.append((step, timeout, step_progress))
+        return planned, predicted_time
+
+    @staticmethod
+    def changed_runs(changed, image_len, sector_size):
+        """Merge neighbouring changed sectors, so each run is erased and
+        written at once.
+
+        Args:
+            changed (list): Offsets of changed sectors, in ascending order.
+            image_len (int): Length of the image in bytes.
+            sector_size (int): Size of flash sector in bytes.
+
+        Returns:
+            list: Runs, as lists of start and end (exclusive) offset.
+        """
+
+        sectors_amount = (image_len + sector_size - 1) // sector_size
+        logging.info(f"{len(changed)} of {sectors_amount} sectors changed")
+
+        runs = []
+        for offset in changed:
+            if runs and runs[-1][1] == offset:
+                runs[-1][1] = offset + sector_size
+            else:
+                runs.append([offset, offset + sector_size])
+        return runs
+
+class BLFlasher(BLFlasherBase):
+    def __init__(self, bl_uart, bl_proto = None, progress = None):
+        """
+        Args:
+            bl_uart (BLUart): Connection with MCU.
+            bl_proto (BLProtocol): Protocol on top of bl_uart, None creates
+                a new one.
+            progress (callable): Called with Progress during eflash loader
+                upload, erase and write.
+        """
+
+        # Protocol owns RX state of the connection, it must be shared with
+        # anyone else talking to the same UART
+        if bl_proto is None:
+            bl_proto = BLProtocol(bl_uart)
+        super().__init__(bl_uart, bl_proto, progress)
 
     def single_connect(self):
-        self.__bl_uart.enter_bootloader()
+        self.bl_uart.enter_bootloader()
+        return self.wait_ready()
+
+    def wait_ready(self, max_time = 1.0):
+        """Probe MCU with handshakes until it responds.
+
+        Args:
+            max_time (float): Max probing time, given in seconds.
+
+        Returns:
+            bool: True if MCU responded to handshake.
+        """
+
         try:
-            self.__bl_proto.handshake()
+            stats = self.bl_proto.handshake(max_time = max_time)
         except bl_errors.InvalidResponseError:
             return False
-        else:
-            return True
+        logging.debug(f"Ready after {stats.attempts} handshakes, "
+                      f"{stats.elapsed:.3f} s")
+        return True
 
     def connect(self, retries_amount = 3):
         for attempt in range(retries_amount):
+            if attempt > 0 and self.bl_proto.stats is not None:
+                self.bl_proto.stats.retry('connect')
             if self.single_connect():
                 return True
         return False
 
     def flash_efloader(self, efl_path):
-            with open(efl_path, 'rb') as efl_file:
-                # Load boot header of eflash loader
-                self.__bl_proto.load_boot_header(efl_file.read(176))
+            efl_image = load_efloader_image(efl_path)
+            # Load boot header of eflash loader
+            self.bl_proto.load_boot_header(efl_image.boot_header)
 
-                # Load segment header of eflash loader
-                shr = self.__bl_proto.load_segment_header(efl_file.read(16))
-                logging.debug(f"LoadSegmentHeader response: {shr}")
-                self.__bl_proto.load_full_data(efl_file)
-                img_status = self.__bl_proto.check_image()
+            # Load segment header of eflash loader
+            shr = self.bl_proto.load_segment_header(efl_image.segment_header)
+            logging.debug(f"LoadSegmentHeader response: {shr}")
+            self.bl_proto.load_full_data(efl_image.segment_data,
+                                         self.progress)
+            img_status = self.bl_proto.check_image()
 
             if img_status is True:
                 logging.info("Eflash loader has been loaded succesfully")
 
-    def flash_img_bootheader(self, data):
+    def flash_img_bootheader(self, data, erase = True):
             # Make space for img's bootheader
-            self.__bl_proto.flash_erase(0x0000, 0x00AF)
+            if erase:
+                self.erase(0x0000, 0x00AF)
             # Load bootheader of img
-            self.__bl_proto.flash_write(0x0000, data)
+            self.bl_proto.flash_write(0x0000, data)
             # Check write
-            fwcr = self.__bl_proto.flash_write_check()
+            fwcr = self.bl_proto.flash_write_check()
             logging.debug(f"Flash write check response {fwcr}")
             # Check sha
-            self.__bl_proto.xip_read_start()
-            sha = self.__bl_proto.flash_xip_readsha(b'\xB8\x08\x00\x00\x00\x00\x00\xB0\x00\x00\x00')
+            self.bl_proto.xip_read_start()
+            sha = self.bl_proto.flash_xip_readsha(0x0000, len(data))
             logging.info(f"FlashXipReadSha response: {sha}")
-            self.__bl_proto.xip_read_finish()
+            self.bl_proto.xip_read_finish()
+            self.verify_sha(hashlib.sha256(data).digest(), sha)
+
+    def probe_efloader(self, baudrates):
+        """Check if eflash loader is already running on MCU.
+
+        MCU isn't reset, so loader left by previous session can be reused.
+        Bootloader in ROM doesn't know "read_jedecid" command.
+
+        Args:
+            baudrates (list): Baudrates to probe, in order.
+
+        Returns:
+            bool: True if eflash loader responded, link is left at the
+                baudrate it responded at.
+        """
+
+        safe_baudrate = self.bl_uart.baudrate
+        for baudrate in baudrates:
+            self.bl_uart.set_baudrate(baudrate)
+            try:
+                self.bl_proto.handshake(max_time = 0.1)
+                self.bl_proto.read_jedecid()
+            except bl_errors.BLBootProtocolError:
+                continue
+            return True
+
+        self.bl_uart.set_baudrate(safe_baudrate)
+        return False
+
+    def prepare(self, efl_path, load_baudrate = None, reuse = False):
+        """Connect to MCU and start eflash loader on it.
+
+        Handshake and eflash loader upload are done at UART's baudrate, which
+        is considered safe. Afterwards link is switched to load_baudrate for
+        the rest of the session. If that fails, whole procedure is repeated
+        at safe baudrate.
+
+        Probing for running eflash loader costs a few handshake timeouts on
+        freshly reset MCU, so reuse is off by default.
+
+        Args:
+            efl_path (str): Path to eflash loader image.
+            load_baudrate (int): Baudrate used once eflash loader is running.
+                None keeps the safe one.
+            reuse (bool): Skip upload if eflash loader is already running.
+
+        Returns:
+            bytearray: Boot info reported by MCU's bootloader, None if
+                running eflash loader was reused.
+
+        Raises:
+            ConnectError: If bootloader did not respond to handshake.
+        """
+
+        if reuse:
+            if self.probe_efloader(self.probe_baudrates(load_baudrate)):
+                logging.info("Eflash loader is already running, "
+                             "skipping upload")
+                # Loader may have been left at safe baudrate
+                if load_baudrate and load_baudrate != self.bl_uart.baudrate:
+                    try:
+                        self.escalate_baudrate(load_baudrate)
+                    except bl_errors.ConnectError:
+                        logging.warning("Eflash loader lost at "
+                                        f"{load_baudrate} baud, starting over")
+                        return self.prepare(efl_path)
+                return None
+
+        if not self.connect(2):
+            raise bl_errors.ConnectError("Bootloader is not responding")
+        boot_info = self.bl_proto.get_boot_info()
+        logging.debug(f"GetBootInfo response: {boot_info}")
+        self.flash_efloader(efl_path)
+        self.start_efloader()
+
+        if load_baudrate and load_baudrate != self.bl_uart.baudrate:
+            try:
+                self.escalate_baudrate(load_baudrate)
+            except bl_errors.ConnectError:
+                logging.warning("Eflash loader lost at "
+                                f"{load_baudrate} baud, starting over")
+                return self.prepare(efl_path)
+        return boot_info
+
+    def start_efloader(self):
+        """Run uploaded eflash loader and wait until it responds.
+
+        Raises:
+            ConnectError: If eflash loader did not respond to handshake.
+        """
+
+        #Unknown operation - these commands are not waiting for response
+        for data in EFLOADER_START_SEQUENCE:
+            self.bl_proto.memory_write(data)
+
+        if not self.wait_ready():
+            raise bl_errors.ConnectError("Eflash loader is not responding")
+
+    def escalate_baudrate(self, baudrate, timeout = 0.5):
+        """Switch both host and eflash loader to given baudrate.
+
+        Args:
+            baudrate (int): Baudrate to switch to.
+            timeout (float): Max waiting time for handshake response at new
+                baudrate, given in seconds.
+
+        Returns:
+            bool: True if link runs at new baudrate, False if it stayed
+                at the old one.
+
+        Raises:
+            ConnectError: If eflash loader doesn't respond at any baudrate.
+        """
+
+        safe_baudrate = self.bl_uart.baudrate
+        try:
+            self.bl_proto.change_rate(safe_baudrate, baudrate)
+        except bl_errors.BLBootProtocolError as e:
+            logging.warning(f"Baudrate change rejected: {e!r}")
+            return False
+
+        self.bl_uart.set_baudrate(baudrate)
+        try:
+            self.bl_proto.handshake(max_time = timeout)
+        except bl_errors.BLBootProtocolError:
+            logging.warning(f"No handshake at {baudrate} baud, "
+                            f"falling back to {safe_baudrate}")
+        else:
+            logging.info(f"Switched to {baudrate} baud")
+            return True
+
+        # Eflash loader may still be listening at old baudrate
+        self.bl_uart.set_baudrate(safe_baudrate)
+        try:
+            self.bl_proto.handshake(max_time = timeout)
+        except bl_errors.BLBootProtocolError:
+            raise bl_errors.ConnectError("Eflash loader is not responding")
+        return False
+
+    def read_device_info(self):
+        """Read MAC address and flash JEDEC ID through eflash loader.
+
+        Returns:
+            tuple: MAC address and JEDEC ID, both as bytearray.
+        """
+
+        mac_addr = self.bl_proto.efuse_read_mac_addr()
+        logging.info(f"EfuseReadMacAddr response: {mac_addr}")
+        jedecid = self.bl_proto.read_jedecid()
+        logging.info(f"ReadJededId response: {jedecid}")
+        return mac_addr, jedecid
+
+    def erase(self, start_addr, end_addr, allow_chip_erase = False):
+        """Erase flash region with the cheapest mix of erase commands.
+
+        Without flash configuration whole region is erased with single
+        command and MCU decides how.
+
+        Args:
+            start_addr (int): Starting address for memory erasing.
+            end_addr (int): Ending address for memory erasing.
+            allow_chip_erase (bool): Allow erasing whole chip if it's faster.
+
+        Returns:
+            float: Predicted erase time in seconds, None if unknown.
+        """
+
+        if self.erase_planner is None:
+            self.bl_proto.flash_erase(start_addr, end_addr,
+                                      progress = self.progress)
+            return None
+
+        steps, predicted_time = self.erase_steps(start_addr, end_addr,
+                                                 allow_chip_erase)
+        for step, timeout, step_progress in steps:
+            if step.kind == 'chip':
+                self.bl_proto.flash_chip_erase(timeout)
+                continue
+            # Block erase is much faster than its sectors one by one
+            self.bl_proto.flash_erase(step.start_addr, step.end_addr,
+                                      timeout, step_progress, step.time)
+        return predicted_time
+
+    def flash_firmware(self, image, start_addr = 0x2000,
+                       bootinfo_path = 'utils/bootinfo.cfg',
+                       chunk_size = 4096, window = 1, incremental = False,
+                       chip_erase = False, compress = False):
+        """Write firmware image with its bootheader into MCU's flash.
+
+        Args:
+            image (BLImage): Firmware image, can be shared between flashers.
+            start_addr (int): Flash address of the image.
+            bootinfo_path (str): Path to bootheader configuration.
+            chunk_size (int): Payload size of a single "flash_write" command.
+            window (int): Max number of unacknowledged "flash_write" commands.
+            incremental (bool): Erase and write only sectors which content
+                differs from the image.
+            chip_erase (bool): Allow erasing whole chip if it's faster than
+                erasing image region.
+            compress (bool): Send image XZ compressed, falls back to plain
+                writes if eflash loader doesn't support it.
+
+        Returns:
+            bytearray: SHA of written region reported by MCU.
+
+        Raises:
+            VerifyError: If SHA reported by MCU doesn't match the image.
+        """
+
+        bin_size = len(image)
+
+        end_addr = start_addr + bin_size - 1
+
+        plan = self.plan_firmware(image, start_addr, bootinfo_path,
+                                  incremental, chip_erase)
+        chip_erased = plan.chip_erase
+        if chip_erased:
+            self.erase(start_addr, end_addr, True)
+
+        self.flash_img_bootheader(plan.bootinfo.get_bytes(),
+                                  erase = not chip_erased)
+
+        if plan.incremental:
+            self.flash_changed_sectors(start_addr, image.data,
+                                       plan.sector_size, chunk_size, window)
+            img_sha = hashlib.sha256(image.data).digest()
+        else:
+            logging.info(f"Binary size: {bin_size}, start {start_addr}, end {end_addr}")
+            #FlashErase
+            if not chip_erased:
+                self.erase(start_addr, end_addr)
+
+            #FlashWrite
+            img_sha = None
+            if compress:
+                img_sha = self.write_compressed(start_addr, image.data,
+                                                chunk_size, window)
+            if img_sha is None:
+                img_sha = self.bl_proto.flash_write_all(
+                    start_addr, image.data, chunk_size, window,
+                    progress = self.progress)
+
+        #FlashWriteCheck
+        self.bl_proto.flash_write_check()
+
+        #XipReadStart
+        self.bl_proto.xip_read_start()
+
+        sha = self.bl_proto.flash_xip_readsha(start_addr, bin_size)
+        logging.info(f"FlashXipReadSha response: {sha}")
+
+        #XipReadStart
+        self.bl_proto.xip_read_finish()
+
+        self.verify_sha(img_sha, sha)
+        return sha
+
+    def write_compressed(self, start_addr, data, chunk_size = 4096,
+                         window = 1):
+        """Write erased region with compressed data.
+
+        Args:
+            start_addr (int): Flash address of the data.
+            data (bytes-like): Data to write.
+            chunk_size (int): Compressed payload size of a single command.
+            window (int): Max number of unacknowledged commands.
+
+        Returns:
+            bytes: SHA-256 digest of written data or None if eflash loader
+                doesn't support compressed writes.
+        """
+
+        try:
+            return self.bl_proto.flash_decompress_write_all(start_addr, data,
+                                                            chunk_size,
+                                                            window,
+                                                            self.progress)
+        except bl_errors.IdError:
+            logging.warning("Compressed write not supported by eflash loader, "
+                            "falling back to plain write")
+            return None
+
+    def find_changed_sectors(self, start_addr, image, sector_size):
+        """Compare image with flash content sector by sector.
+
+        Args:
+            start_addr (int): Flash address of the image.
+            image (bytes-like): Image content.
+            sector_size (int): Size of flash sector in bytes.
+
+        Returns:
+            list: Offsets (relative to image start) of sectors which differ.
+        """
+
+        changed = []
+        self.bl_proto.xip_read_start()
+        for offset in range(0, len(image), sector_size):
+            block = image[offset:offset + sector_size]
+            device_sha = self.bl_proto.flash_xip_readsha(start_addr + offset,
+                                                         len(block))
+            if device_sha != hashlib.sha256(block).digest():
+                changed.append(offset)
+        self.bl_proto.xip_read_finish()
+        return changed
+
+    def flash_changed_sectors(self, start_addr, image, sector_size,
+                              chunk_size = 4096, window = 1):
+        """Erase and write only sectors which content differs from image.
+
+        Args:
+            start_addr (int): Flash address of the image, sector aligned.
+            image (bytes-like): Image content.
+            sector_size (int): Size of flash sector in bytes.
+            chunk_size (int): Payload size of a single "flash_write" command.
+            window (int): Max number of unacknowledged "flash_write" commands.
+        """
+
+        changed = self.find_changed_sectors(start_addr, image, sector_size)
+        for run_start, run_end in self.changed_runs(changed, len(image),
+                                                    sector_size):
+            data = image[run_start:run_end]
+            self.erase(start_addr + run_start,
+                       start_addr + run_start + len(data) - 1)
+            self.bl_proto.flash_write_all(start_addr + run_start, data,
+                                          chunk_size, window,
+                                          progress = self.progress)
@@ -0,0 +1,116 @@
+"""This module contains BLFrameDecoder class, which splits raw byte stream
+received from MCU into complete ISP protocol responses.
+
+Supported response shapes:
+    OK                      - command succeeded
+    OK + len(2) + payload   - command succeeded and returned data
+    FL + err(2)             - command failed with given error code
+    PD                      - command is still pending
+
+Plain OK and OK with payload look the same on the wire, so decoder has to be
+told which shape the next response will have, see BLFrameDecoder.expect().
+
+Decoder is not thread-safe, when data is fed from another thread than
+commands are announced from, caller has to serialize the calls.
+
+"""
+
+import collections
+import logging
+
+
+class BLFrameDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.read_pos = 0
+        # One entry per command waiting for response, True if response
+        # carries payload
+        self.expected = collections.deque()
+
+    def expect(self, with_payload = False):
+        """Announce shape of response to the command which is about to be sent.
+
+        Args:
+            with_payload (bool): True if OK response carries length and payload.
+        """
+
+        self.expected.append(with_payload)
+
+    def reset(self):
+        """Drop buffered data and all announced responses."""
+
+        self.buffer.clear()
+        self.read_pos = 0
+        self.expected.clear()
+
+    def feed(self, data):
+        """Add received data and extract all complete frames.
+
+        Args:
+            data (bytes): Data received from UART.
+
+        Returns:
+            list: Complete frames (bytes), in order of arrival.
+        """
+
+        self.buffer += data
+        frames = []
+        while True:
+            frame_len = self.__next_frame_len()
+            if frame_len is None:
+                break
+            if frame_len == 0:
+                continue
+            # Frames are short, no export of buffer is held between them
+            frames.append(bytes(self.buffer[self.read_pos:
+                                            self.read_pos + frame_len]))
+            self.read_pos += frame_len
+
+        # Compact buffer once per feed, not once per frame
+        if self.read_pos > 0:
+            del self.buffer[:self.read_pos]
+            self.read_pos = 0
+        return frames
+
+    def __next_frame_len(self):
+        """Get length of frame at current read position.
+
+        Returns:
+            int: Frame length, 0 if garbage byte was skipped or None if frame
+                is not complete yet.
+        """
+
+        available = len(self.buffer) - self.read_pos
+        if available < 2:
+            return None
+
+        status = self.buffer[self.read_pos:self.read_pos + 2]
+        if status == b'PD':
+            return 2
+
+        if status == b'FL':
+            if available < 4:
+                return None
+            self.__pop_expected()
+            return 4
+
+        if status == b'OK':
+            if not self.expected or not self.expected[0]:
+                self.__pop_expected()
+                return 2
+            if available < 4:
+                return None
+            payload_len = int.from_bytes(
+                self.buffer[self.read_pos + 2:self.read_pos + 4], 'little')
+            if available < 4 + payload_len:
+                return None
+            self.__pop_expected()
+            return 4 + payload_len
+
+        logging.debug("Skipping unexpected byte: %#04x", self.buffer[self.read_pos])
+        self.read_pos += 1
+        return 0
+
+    def __pop_expected(self):
+        if self.expected:
+            self.expected.popleft()
@@ -0,0 +1,49 @@
+"""This module contains BLImage class, which gives read-only, memory-mapped
+access to image files sent to MCU.
+
+One BLImage can be shared between many connections, every one of them
+slices memoryviews from the same mapping.
+
+"""
+
+import logging
+import mmap
+
+
+class BLImage:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            try:
+                self.__mmap = mmap.mmap(file.fileno(), 0,
+                                        access = mmap.ACCESS_READ)
+            except ValueError:
+                # Empty file can't be mapped
+                self.__mmap = None
+
+        self.data = memoryview(self.__mmap if self.__mmap is not None else b'')
+
+    def __len__(self):
+        return len(self.data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Release the mapping, slices of data can't be used afterwards.
+
+        Slices which are still alive (e.g. kept by traceback of failed
+        flashing) hold the mapping open, it is unmapped once they are
+        garbage collected.
+        """
+
+        try:
+            self.data.release()
+            if self.__mmap is not None:
+                self.__mmap.close()
+        except BufferError:
+            logging.debug("%s is still in use, leaving it mapped", self.path)
+        self.__mmap = None
@@ -0,0 +1,111 @@
+"""This module contains progress reporting of long running operations.
+
+Operations take optional progress callback, which is called with Progress
+every time some data is done. ProgressMeter turns amounts of done bytes
+into such reports, ConsoleProgress is a callback rendering them as
+a single, rate limited console line.
+
+"""
+
+import collections
+import sys
+import time
+
+Progress = collections.namedtuple(
+    'Progress', ['operation', 'done', 'total', 'rate', 'average_rate', 'eta'])
+Progress.__doc__ = """State of operation.
+
+    operation (str): Operation name, e.g. "write".
+    done (int): Bytes done.
+    total (int): Bytes to do.
+    rate (float): Recent throughput in bytes per second, None if unknown.
+    average_rate (float): Throughput since start, None if unknown.
+    eta (float): Estimated remaining time in seconds, None if unknown.
+"""
+
+
+class ProgressMeter:
+    def __init__(self, callback, operation, total, smoothing = 0.3):
+        """
+        Args:
+            callback (callable): Function taking Progress.
+            operation (str): Operation name.
+            total (int): Bytes to do.
+            smoothing (float): Weight of the newest sample in recent
+                throughput, in range 0..1.
+        """
+
+        self.callback = callback
+        self.operation = operation
+        self.total = total
+        self.smoothing = smoothing
+        self.start = self.last_time = time.monotonic()
+        self.last_done = 0
+        self.rate = None
+
+    def update(self, done):
+        """Report amount of bytes done so far.
+
+        Args:
+            done (int): Bytes done since start of operation.
+        """
+
+        now = time.monotonic()
+        interval = now - self.last_time
+        if interval > 0 and done > self.last_done:
+            rate = (done - self.last_done) / interval
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate += self.smoothing * (rate - self.rate)
+            self.last_time = now
+            self.last_done = done
+
+        elapsed = now - self.start
+        average_rate = done / elapsed if elapsed > 0 and done > 0 else None
+        eta = None
+        if average_rate:
+            eta = (self.total - done) / average_rate
+        self.callback(Progress(self.operation, done, self.total, self.rate,
+                               average_rate, eta))
+
+
+class ConsoleProgress:
+    def __init__(self, stream = sys.stderr, interval = 0.2):
+        """
+        Args:
+            stream (file): Output stream.
+            interval (float): Min time between redraws, given in seconds.
+                Start and end of operation are always drawn.
+        """
+
+        self.stream = stream
+        self.interval = interval
+        self.operation = None
+        self.last_draw = 0.0
+
+    def __call__(self, progress):
+        now = time.monotonic()
+        finished = progress.done >= progress.total
+        new_operation = progress.operation != self.operation
+        if not (finished or new_operation
+                or now - self.last_draw >= self.interval):
+            return
+
+        self.last_draw = now
+        self.operation = None if finished else progress.operation
+
+        percent = 100 * progress.done / progress.total if progress.total else 100
+        line = (f"\r{progress.operation:<10} {percent:5.1f}% "
+                f"{progress.done / 1024:8.1f}/{progress.total / 1024:.1f} KB")
+        if progress.rate is not None:
+            line += f" | {progress.rate / 1024:7.1f} KB/s"
+        if progress.average_rate is not None:
+            line += f" | avg {progress.average_rate / 1024:7.1f} KB/s"
+        if progress.eta is not None and not finished:
+            line += f" | ETA {progress.eta:5.1f} s"
+        # Pad over leftovers of longer previous line
+        self.stream.write(f"{line:<80}")
+        if finished:
+            self.stream.write('\n')
+        self.stream.flush()
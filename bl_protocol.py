@@ -1,6 +1,11 @@
 """This module contains BLProtocol class, which is programmer-side
 implementation Bbouffalolab's ISP protocol.
 
+Command tables, timeouts, frame building, handshake retries and pipelined
+write state live in BLProtocolBase, HandshakeRetry and BLWritePipeline, so
+asynchronous variant (see bl_async_protocol) shares them and only does its
+own I/O.
+
 """
 
 import time
@@ -8,13 +13,289 @@ import logging
 import bl_errors
 import queue
 import threading
+import collections
+import hashlib
+import lzma
+from bl_frame import BLFrameDecoder
+from bl_progress import ProgressMeter
+
+HandshakeStats = collections.namedtuple('HandshakeStats',
+                                        ['attempts', 'elapsed'])
+
+# Compression settings of "flash_decompress_write", dictionary has to fit
+# into eflash loader's RAM
+XZ_FILTERS = [{'id' : lzma.FILTER_LZMA2, 'preset' : 9, 'dict_size' : 32768}]
+XZ_INPUT_BLOCK = 64 * 1024
+
+# Flash timing used for timeouts, in seconds
+DEFAULT_SECTOR_SIZE = 4096
+DEFAULT_SECTOR_ERASE_TIME = 0.3
+DEFAULT_PAGE_SIZE = 256
+DEFAULT_PAGE_PROGRAM_TIME = 0.005
+
+# Eflash loader keeps commands waiting for execution in RX buffer of this
+# size, frames which don't fit are silently dropped
+LOADER_RX_BUFFER_SIZE = 16 * 1024
+
+def max_window_for(chunk_size):
+    """Get max number of unacknowledged commands with given payload size.
+
+    All of them have to fit into eflash loader's RX buffer at once, e.g.
+    3 commands of 4096 bytes.
+
+    Args:
+        chunk_size (int): Payload size of a single command.
+
+    Returns:
+        int: Max window, at least 1.
+    """
+
+    return max(1, LOADER_RX_BUFFER_SIZE // (8 + chunk_size))
+
+class HandshakeRetry:
+    """Retry policy of handshake, shared by BLProtocol and AsyncBLProtocol.
+
+    Iterating gives waiting time for response to every attempt. It doubles
+    with every attempt (up to 0.2 s) and attempts stop once max_time
+    elapses.
+    """
+
+    def __init__(self, timeout, max_time):
+        self.timeout = timeout
+        self.max_time = max_time
+        self.start = time.monotonic()
+        self.attempts = 0
+
+    def __iter__(self):
+        timeout = self.timeout
+        while True:
+            self.attempts += 1
+            yield timeout
+            if time.monotonic() - self.start >= self.max_time:
+                return
+            timeout = min(timeout * 2, 0.2)
+
+    def stats(self):
+        return HandshakeStats(self.attempts, time.monotonic() - self.start)
+
+class BLWritePipeline:
+    """Transport independent state of pipelined flash writing.
+
+    Command generators (write(), decompress_write()) give frames to
+    send, every frame counts as in flight once it's given. Driver, i.e.
+    flash_write_all() of BLProtocol or AsyncBLProtocol, sends them and collects
+    final responses with acknowledge() while full() and, after the last
+    command, until nothing is in flight. MCU answers in order of sending, so
+    every final response belongs to the oldest command in flight.
+    """
+
+    def __init__(self, proto, chunk_size, window, progress = None, total = 0):
+        """
+        Args:
+            proto (BLProtocolBase): Protocol building the commands.
+            chunk_size (int): Payload size of a single command.
+            window (int): Max number of unacknowledged commands, limited
+                so that they fit into eflash loader's RX buffer together.
+            progress (callable): Called with Progress after every chunk.
+            total (int): Amount of bytes to write.
+        """
+
+        if not 0 < chunk_size <= 8000:
+            raise ValueError("Chunk size must be in range 1..8000 bytes")
+        if window < 1:
+            raise ValueError("Window must be at least 1")
+        max_window = max_window_for(chunk_size)
+        if window > max_window:
+            logging.debug(f"Window limited to {max_window} commands of "
+                          f"{chunk_size} bytes by eflash loader's RX buffer")
+            window = max_window
+
+        self.proto = proto
+        self.chunk_size = chunk_size
+        self.window = window
+        self.meter = None
+        if progress is not None:
+            self.meter = ProgressMeter(progress, 'write', total)
+
+        # Commands waiting for acknowledge
+        self.in_flight = collections.deque()
+        self.sha = hashlib.sha256()
+        self.skipped = 0
+
+    def full(self):
+        return len(self.in_flight) >= self.window
+
+    def timeout(self):
+        """Get response timeout of the oldest command in flight, in seconds."""
+
+        return self.in_flight[0][2]
+
+    def acknowledge(self, response):
+        """Take final response of the oldest command in flight.
+
+        Args:
+            response (bytes): Final response frame.
+
+        Raises:
+            BLBootProtocolError: If MCU reported error, command stays the
+                oldest one in flight.
+        """
+
+        self.proto.is_response_ok(response)
+        self.in_flight.popleft()
+
+    def fail(self):
+        """Drop all commands in flight, the oldest of them failed.
+
+        Logged at debug level only, raised exception tells the caller what
+        went wrong and some errors (e.g. IdError of compressed write) are
+        expected.
+
+        Returns:
+            list: Response timeouts of the other commands, their responses
+                still have to be collected to keep RX stream in sync.
+        """
+
+        kind, addr, _ = self.in_flight.popleft()
+        logging.debug(f"Flash {kind} at {addr:#x} failed")
+        timeouts = [timeout for _, _, timeout in self.in_flight]
+        self.in_flight.clear()
+        return timeouts
+
+    def finish(self):
+        """Report statistics of finished procedure.
+
+        Returns:
+            bytes: SHA-256 digest of written data.
+        """
+
+        if self.skipped:
+            logging.debug("Skipped %d erased chunks", self.skipped)
+        return self.sha.digest()
+
+    def __send(self, kind, addr, timeout):
+        self.in_flight.append((kind, addr, timeout))
+
+    def write(self, start_addr, data, skip_erased = True):
+        """Generate commands writing data chunk by chunk.
+
+        Args:
+            start_addr (int): Starting address for memory writing.
+            data (bytes-like): Data to write, e.g. slice of BLImage.
+            skip_erased (bool): Don't send chunks consisting only of 0xFF.
+
+        Yields:
+            memoryview: Command frame, valid until the next one is generated.
+        """
+
+        proto = self.proto
+        view = memoryview(data)
+        end_addr = start_addr + len(view)
+        # Chunks are copied straight into TX buffer, right after command
+        # header. Buffer can be reused as soon as previous command is handed
+        # to interface.
+        payload = proto.tx_view[8:8 + self.chunk_size]
+        # Oldest command may wait for all others in the window to be sent
+        write_timeout = self.window * proto.write_timeout(self.chunk_size)
+        # Slicing it to full chunk length doesn't copy
+        erased = b'\xff' * self.chunk_size
+
+        addr = start_addr
+        while addr < end_addr:
+            offset = addr - start_addr
+            chunk = view[offset:offset + self.chunk_size]
+            dlen = len(chunk)
+            payload[:dlen] = chunk
+            self.sha.update(chunk)
+            addr = addr + dlen
+            # Compared in TX buffer, without copying the chunk again
+            if skip_erased and proto.tx_buffer.startswith(erased[:dlen], 8):
+                self.skipped = self.skipped + 1
+            else:
+                self.__send('write', addr - dlen, write_timeout)
+                yield proto.build_flash_write(addr - dlen, dlen)
+            if self.meter is not None:
+                self.meter.update(addr - start_addr)
+
+    def decompress_write(self, start_addr, data):
+        """Generate commands writing data in XZ compressed form.
+
+        Data is compressed on the fly and eflash loader expands it into
+        flash. Progress is reported in uncompressed bytes, estimated from
+        compression ratio.
+
+        Args:
+            start_addr (int): Starting address for memory writing.
+            data (bytes-like): Data to write, e.g. slice of BLImage.
 
-rx_queue = queue.Queue()
+        Yields:
+            memoryview: Command frame, valid until the next one is generated.
+        """
 
-class BLProtocol:
-    def __init__(self, interface):
+        proto = self.proto
+        chunk_size = self.chunk_size
+        compressor = lzma.LZMACompressor(format = lzma.FORMAT_XZ,
+                                         check = lzma.CHECK_CRC32,
+                                         filters = XZ_FILTERS)
+        view = memoryview(data)
+        payload = proto.tx_view[8:8 + chunk_size]
+        # Compressed data waiting to be sent and position of its first byte
+        compressed = bytearray()
+        sent = 0
+        # Address is advanced by compressed length, MCU tracks output itself
+        addr = start_addr
+        consumed = 0
+
+        offset = 0
+        while True:
+            block = view[offset:offset + XZ_INPUT_BLOCK]
+            offset = offset + len(block)
+            if len(block) > 0:
+                self.sha.update(block)
+                compressed += compressor.compress(block)
+                consumed = offset
+                final = False
+            else:
+                compressed += compressor.flush()
+                final = True
+
+            while (len(compressed) - sent >= chunk_size
+                   or (final and len(compressed) > sent)):
+                chunk = compressed[sent:sent + chunk_size]
+                dlen = len(chunk)
+                payload[:dlen] = chunk
+                sent = sent + dlen
+                # Chunk can expand a lot, scale timeout with the compression
+                # ratio seen so far
+                expanded = max(dlen, dlen * consumed
+                                      // (addr - start_addr + dlen))
+                self.__send('decompress write', addr,
+                            self.window * proto.write_timeout(expanded))
+                yield proto.build_flash_write(addr, dlen,
+                                              'flash_decompress_write')
+                addr = addr + dlen
+                if self.meter is not None:
+                    produced = addr - start_addr + len(compressed) - sent
+                    self.meter.update(consumed * (addr - start_addr)
+                                      // produced)
+
+            # Drop what was already sent, once per input block
+            del compressed[:sent]
+            sent = 0
+            if final:
+                break
+
+        logging.debug("Sent %d compressed bytes for %d bytes of data",
+                      addr - start_addr, len(view))
+
+class BLProtocolBase:
+    """Transport independent part of ISP protocol: command tables, timeouts,
+    frame building, statistics and response parsing. Shared by BLProtocol
+    and AsyncBLProtocol.
+    """
+
+    def __init__(self, interface, stats = None):
         self.interface = interface
-        self.interface.register_rx_callback(self.rx_callback_handler)
 
         self.cmd_id = {
             'handshake' : b'\x55',
@@ -32,14 +313,152 @@ class BLProtocol:
             'flash_xip_readsha' : b'\x3E',
             'xip_read_finish' : b'\x61',
             'efuse_read_mac_addr' : b'\x42',
+            'change_rate' : b'\x20',
+            'flash_chip_erase' : b'\x3C',
+            'flash_decompress_write' : b'\x3F',
         }
 
+        # Base response timeouts, in seconds. Time needed to transfer command
+        # is added on top, erase and write are scaled by amount of data.
+        self.cmd_timeout = {
+            'handshake' : 0.05,
+            'get_boot_info' : 0.5,
+            'load_boot_header' : 0.5,
+            'load_segment_header' : 0.5,
+            'load_segment_data' : 0.5,
+            'check_image' : 1.0,
+            'read_jedecid' : 0.5,
+            'flash_erase' : 1.0,
+            'flash_write' : 0.5,
+            'flash_write_check' : 1.0,
+            'xip_read_start' : 0.5,
+            'flash_xip_readsha' : 1.0,
+            'xip_read_finish' : 0.5,
+            'efuse_read_mac_addr' : 0.5,
+            'change_rate' : 0.5,
+            'flash_chip_erase' : 1.0,
+            'flash_decompress_write' : 0.5,
+        }
+        self.cmd_name = {cmd_id[0] : name for name, cmd_id in self.cmd_id.items()}
+
+        # Flash timing, used to scale erase and write timeouts
+        self.sector_size = DEFAULT_SECTOR_SIZE
+        self.sector_erase_time = DEFAULT_SECTOR_ERASE_TIME
+        self.page_size = DEFAULT_PAGE_SIZE
+        self.page_program_time = DEFAULT_PAGE_PROGRAM_TIME
+
+        # Optional BLStats, commands awaiting response are tracked only
+        # when it's given
+        self.stats = stats
+        self.stats_in_flight = collections.deque()
+
+        # Reusable TX frame buffer, big enough for the longest command.
+        # Payload is placed right after the header, so each chunk is copied
+        # into it once and sent from there.
+        self.tx_buffer = bytearray(8 + 8000)
+        self.tx_view = memoryview(self.tx_buffer)
+
+        # Result of last succesful handshake
+        self.handshake_stats = None
+
+    def set_flash_timing(self, flash_cfg):
+        """Take flash timing used for timeouts from flash configuration.
+
+        Args:
+            flash_cfg (SpiFlashCfg): Flash configuration from bootheader.
+        """
+
+        # Sizes are given in KB and bytes, times in milliseconds
+        self.sector_size = flash_cfg.sector_size * 1024
+        self.sector_erase_time = flash_cfg.sector_erase_time / 1000
+        self.page_size = flash_cfg.page_size
+        self.page_program_time = flash_cfg.page_program_time / 1000
+
+    def transfer_time(self, size):
+        """Calculate time needed to send given amount of bytes.
+
+        Args:
+            size (int): Amount of bytes.
+
+        Returns:
+            float: Time in seconds, 10 bits per byte.
+        """
+
+        return size * 10 / self.interface.baudrate
+
+    def erase_time(self, start_addr, end_addr):
+        """Estimate time of erasing region sector by sector.
+
+        Args:
+            start_addr (int): Starting address for memory erasing.
+            end_addr (int): Ending address for memory erasing.
+
+        Returns:
+            float: Time in seconds.
+        """
+
+        first_sector = start_addr // self.sector_size
+        last_sector = end_addr // self.sector_size
+        return (last_sector - first_sector + 1) * self.sector_erase_time
+
+    def erase_timeout(self, start_addr, end_addr):
+        """Calculate response timeout of "flash_erase" command.
+
+        Args:
+            start_addr (int): Starting address for memory erasing.
+            end_addr (int): Ending address for memory erasing.
+
+        Returns:
+            float: Timeout in seconds.
+        """
+
+        return (self.cmd_timeout['flash_erase']
+                + 2 * self.erase_time(start_addr, end_addr))
+
+    def write_timeout(self, dlen):
+        """Calculate response timeout of "flash_write" command.
+
+        Args:
+            dlen (int): Length of payload.
+
+        Returns:
+            float: Timeout in seconds.
+        """
+
+        pages = (dlen + self.page_size - 1) // self.page_size
+        return (self.cmd_timeout['flash_write']
+                + 2 * (self.transfer_time(8 + dlen)
+                       + pages * self.page_program_time))
+
     @staticmethod
-    def rx_callback_handler(data):
-        rx_queue.put(data)
+    def report_erase_progress(meter, elapsed, expected_time):
+        """Report erase progress estimated from elapsed time.
+
+        MCU doesn't report erased amount, estimate stays below total until
+        MCU confirms the erase.
 
-    def get_response(self):
-        return rx_queue.get()
+        Args:
+            meter (ProgressMeter): Meter of the erase, None does nothing.
+            elapsed (float): Time since erase was sent, in seconds.
+            expected_time (float): Predicted erase time, in seconds.
+        """
+
+        if meter is not None and expected_time > 0:
+            done = int(meter.total * elapsed / expected_time)
+            meter.update(min(done, meter.total - 1))
+
+    @staticmethod
+    def get_payload(response):
+        """Extract payload from OK response carrying data.
+
+        Args:
+            response (bytes): MCU response frame.
+
+        Returns:
+            bytes: Payload without status and length fields.
+        """
+
+        return response[4:]
 
     @staticmethod
     def is_response_ok(response):
@@ -55,9 +474,7 @@ class BLProtocol:
             TODO
         """
 
-        logging.debug(f"Response: {response}")
-        #if response is None or len(response) < 2:
-            #raise bl_errors.InvalidResponseError()
+        logging.debug("Response: %s", response)
 
         if response[0:2] == b'OK':
             result = True
@@ -65,7 +482,7 @@ class BLProtocol:
         elif response[0:2] == b'FL':
             err_lsb = response[2]
             err_msb = response[3]
-            logging.debug(f"err_msb: {err_msb}, err_lsb {err_lsb}")
+            logging.debug("err_msb: %s, err_lsb %s", err_msb, err_lsb)
             raise bl_errors.errors_agregator[err_msb][err_lsb - 1]()
 
         else:
@@ -84,38 +501,314 @@ class BLProtocol:
             int: Calculated checksum.
         """
 
-        logging.debug("Checksum calculation")
-        sum = 0
-        for e in data:
-            sum = sum + e
-        checksum = sum & 0xFF
+        # sum() iterates over bytes in C, no logging here as it runs for
+        # every command payload
+        return sum(data) & 0xFF
+
+    def build_command(self, name, data = b'', checksum = False):
+        """Build command frame.
+
+        Args:
+            name (str): Command name, key of cmd_id.
+            data (bytes-like): Command data.
+            checksum (bool): Fill checksum field, otherwise it stays 0.
+
+        Returns:
+            bytes: Complete command.
+        """
+
+        data = len(data).to_bytes(2, 'little') + bytes(data)
+        chk = self.calc_checksum(data) if checksum else 0
+        return self.cmd_id[name] + chk.to_bytes(1, 'little') + data
+
+    def build_flash_erase(self, start_addr, end_addr):
+        """Build "flash_erase" command.
+
+        Args:
+            start_addr (int): Starting address for memory erasing.
+            end_addr (int): Ending address for memory erasing.
+
+        Returns:
+            bytes: Complete command.
+        """
+
+        data = start_addr.to_bytes(4, 'little') + end_addr.to_bytes(4, 'little')
+        return self.build_command('flash_erase', data, checksum = True)
+
+    def build_load_segment_data(self, dlen):
+        """Fill "load_segment_data" header in TX buffer.
+
+        Args:
+            dlen (int): Length of payload already placed at offset 4.
+
+        Returns:
+            memoryview: Complete command.
+        """
+
+        view = self.tx_view
+        view[0] = self.cmd_id['load_segment_data'][0]
+        view[1] = 0
+        view[2:4] = dlen.to_bytes(2, 'little')
+        return view[:4 + dlen]
+
+    def build_flash_write(self, start_addr, dlen, cmd = 'flash_write'):
+        """Fill "flash_write" header in TX buffer.
+
+        Args:
+            start_addr (int): Starting address for memory writing.
+            dlen (int): Length of payload already placed at offset 8.
+            cmd (str): Command with "flash_write" layout.
+
+        Returns:
+            memoryview: Complete command.
+        """
+
+        view = self.tx_view
+        view[0] = self.cmd_id[cmd][0]
+        view[2:4] = (dlen + 4).to_bytes(2, 'little')
+        view[4:8] = start_addr.to_bytes(4, 'little')
+        view[1] = self.calc_checksum(view[2:8 + dlen])
+        return view[:8 + dlen]
+
+    def record_command(self, data, with_response = True):
+        """Account command which is about to be sent in statistics.
+
+        Args:
+            data (bytes-like): Command.
+            with_response (bool): False if MCU doesn't answer the command.
+        """
+
+        if self.stats is None:
+            return
+        name = self.cmd_name.get(data[0], 'unknown')
+        self.stats.command_sent(name, len(data))
+        if with_response:
+            self.stats_in_flight.append((name, time.monotonic()))
+
+    def record_response(self, response):
+        """Account response to the oldest command awaiting it."""
+
+        if self.stats is None or not self.stats_in_flight:
+            return
+        name, sent = self.stats_in_flight[0]
+        if response[0:2] == b'PD':
+            self.stats.pending(name)
+            return
+        self.stats_in_flight.popleft()
+        self.stats.response_received(name, len(response),
+                                     time.monotonic() - sent,
+                                     response[0:2] == b'OK')
+
+    def record_timeout(self):
+        """Account missing response to the oldest command awaiting it."""
+
+        if self.stats is not None and self.stats_in_flight:
+            self.stats.timeout(self.stats_in_flight[0][0])
+
+    def handshake_retry(self, timeout = None, max_time = 0):
+        """Start handshake, see BLProtocol.handshake() for arguments.
+
+        Returns:
+            HandshakeRetry: Waiting times of attempts.
+        """
+
+        logging.debug("Handshake")
+        if timeout is None:
+            timeout = self.cmd_timeout['handshake']
+        return HandshakeRetry(timeout, max_time)
+
+    def handshake_burst(self, burst_time):
+        """Build burst of sync bytes lasting burst_time on the line."""
+
+        burst_len = max(16, int(burst_time * (self.interface.baudrate / 10)))
+        return self.cmd_id['handshake'] * burst_len
+
+    def handshake_done(self, retry, ok):
+        """Finish handshake.
+
+        Args:
+            retry (HandshakeRetry): Attempts made.
+            ok (bool): True if MCU responded.
+
+        Returns:
+            HandshakeStats: Amount of attempts and time spent on sync.
+
+        Raises:
+            InvalidResponseError: If MCU didn't respond.
+        """
+
+        stats = retry.stats()
+        if self.stats is not None and stats.attempts > 1:
+            self.stats.retry('handshake', stats.attempts - 1)
+        if not ok:
+            logging.debug("Handshake failed after %d attempts", stats.attempts)
+            raise bl_errors.InvalidResponseError()
+        self.handshake_stats = stats
+        logging.debug("Handshake done in %d attempts, %.1f ms",
+                      stats.attempts, stats.elapsed * 1000)
+        return stats
+
+class BLProtocol(BLProtocolBase):
+    def __init__(self, interface, stats = None):
+        super().__init__(interface, stats)
+        # RX state belongs to connection, so many instances can work at once.
+        # Decoder is fed by RX thread, lock keeps it and the queue consistent
+        # with flushes and announced responses from caller's thread.
+        self.rx_queue = queue.Queue()
+        self.rx_decoder = BLFrameDecoder()
+        self.rx_lock = threading.Lock()
+
+        self.interface.register_rx_callback(self.rx_callback_handler)
+
+    def rx_callback_handler(self, data):
+        with self.rx_lock:
+            for frame in self.rx_decoder.feed(data):
+                self.rx_queue.put(frame)
+
+    def flush_rx(self):
+        """Drop all received data and responses nobody waits for."""
+
+        with self.rx_lock:
+            self.rx_decoder.reset()
+            while not self.rx_queue.empty():
+                self.rx_queue.get_nowait()
+        self.stats_in_flight.clear()
+
+    def get_response(self, timeout = None):
+        """Get next response frame.
+
+        After timeout the response may still come later, so RX state should
+        be flushed (e.g. by handshake) before connection is used again.
+
+        Args:
+            timeout (float): Max waiting time for response, given in seconds.
+                None means wait forever.
+
+        Returns:
+            bytes: Response frame.
+
+        Raises:
+            ResponseTimeoutError: If no response came in time.
+        """
+
+        try:
+            response = self.rx_queue.get(timeout = timeout)
+        except queue.Empty:
+            self.record_timeout()
+            raise bl_errors.ResponseTimeoutError(
+                f"No response within {timeout:.3f} s") from None
+        self.record_response(response)
+        return response
+
+    def get_final_response(self, deadline):
+        """Get next response, skipping PD responses.
+
+        Args:
+            deadline (float): Time on monotonic clock the final response
+                has to come before.
+
+        Returns:
+            bytes: Response frame.
 
-        logging.debug(f"Checksum value: {checksum}")
-        return checksum
+        Raises:
+            ResponseTimeoutError: If no final response came in time.
+        """
 
-    def send_data_wait_for_response(self, data, timeout=0.1):
+        response = self.get_response(max(0, deadline - time.monotonic()))
+        while response[0:2] == b'PD':
+            logging.debug("Pending...")
+            response = self.get_response(max(0, deadline - time.monotonic()))
+        return response
+
+    def send_data_wait_for_response(self, data, timeout=None,
+                                    with_payload=False):
         """Send data to MCU and wait for its response.
 
         Args:
             data (bytearray): Data to sent.
             timeout (float): Max waiting time for data, given in seconds.
+                None means default timeout of the command.
+            with_payload (bool): True if OK response carries payload.
 
         Returns:
-            bytearray: Data received from UART.
+            bytearray: Response frame received from MCU.
+
+        Raises:
+            ResponseTimeoutError: If no response came in time.
         """
+        if timeout is None:
+            timeout = (self.cmd_timeout[self.cmd_name[data[0]]]
+                       + self.transfer_time(len(data)))
+        self.send_command(data, with_payload)
+        return self.get_response(timeout)
+
+    def send_command(self, data, with_payload=False):
+        """Send data to MCU without waiting for its response.
+
+        Response has to be collected later with get_response(), responses
+        come in the same order as commands were sent.
+
+        Args:
+            data (bytearray): Data to sent.
+            with_payload (bool): True if OK response carries payload.
+        """
+        with self.rx_lock:
+            self.rx_decoder.expect(with_payload)
+        self.record_command(data)
         self.interface.send_data(data)
-        return self.get_response()
 
-    def handshake(self):
+    def handshake(self, timeout = None, max_time = 0, burst_time = 0.002):
         """Perform handshake with MCU's bootloader.
 
+        Short burst of sync bytes is sent and response is awaited for bounded
+        time. Attempts are repeated with growing waiting time until max_time
+        elapses. Stale data is dropped before every attempt.
+
+        Args:
+            timeout (float): Waiting time for response to first attempt,
+                given in seconds. None means default timeout of the command.
+            max_time (float): Max time spent on retries, given in seconds.
+                0 means single attempt.
+            burst_time (float): Duration of sync burst on the line,
+                given in seconds.
+
+        Returns:
+            HandshakeStats: Amount of attempts and time spent on sync.
+
+        Raises:
+            InvalidResponseError: If MCU didn't respond in time.
+        """
+
+        retry = self.handshake_retry(timeout, max_time)
+        command = self.handshake_burst(burst_time)
+        for wait in retry:
+            self.flush_rx()
+            self.send_command(command)
+            try:
+                if self.get_response(wait)[0:2] == b'OK':
+                    return self.handshake_done(retry, True)
+            except bl_errors.ResponseTimeoutError:
+                pass
+        return self.handshake_done(retry, False)
+
+    def change_rate(self, old_baudrate, new_baudrate):
+        """Switch eflash loader's UART to different baudrate.
+
+        Response comes at old baudrate, new one has to be confirmed
+        with handshake afterwards.
+
+        Args:
+            old_baudrate (int): Baudrate currently in use.
+            new_baudrate (int): Baudrate to switch to.
+
         Returns:
             bool: True if operation was succesful.
         """
 
-        logging.debug("Handshake")
-        command = (self.cmd_id['handshake']
-                   * int(0.005 * (self.interface.uart.baudrate / 10)))
+        logging.debug("ChangeRate command")
+        data = (old_baudrate.to_bytes(4, 'little')
+                + new_baudrate.to_bytes(4, 'little'))
+        command = self.build_command('change_rate', data, checksum = True)
         response = self.send_data_wait_for_response(command)
         return self.is_response_ok(response)
 
@@ -127,10 +820,10 @@ class BLProtocol:
         """
 
         logging.debug("GetBootInfo command")
-        command = self.cmd_id['get_boot_info'] + b'\x00\x00\x00'
-        response = self.send_data_wait_for_response(command)
+        command = self.build_command('get_boot_info')
+        response = self.send_data_wait_for_response(command, with_payload=True)
         if self.is_response_ok(response):
-            return response[2:]
+            return self.get_payload(response)
 
     def load_boot_header(self, boot_header):
         """Send "load_boot_header" command to MCU.
@@ -150,8 +843,7 @@ class BLProtocol:
         if len(boot_header) != 176:
             raise bl_errors.InvalidResponseError()
 
-        command = (self.cmd_id['load_boot_header']
-                   + b'\x00\xB0\x00' + boot_header)
+        command = self.build_command('load_boot_header', boot_header)
         response = self.send_data_wait_for_response(command)
         return self.is_response_ok(response)
 
@@ -173,11 +865,10 @@ class BLProtocol:
         if len(segment_header) != 16 :
             raise bl_errors.InvalidResponseError()
 
-        command = (self.cmd_id['load_segment_header']
-                   + b'\x00\x10\x00' + segment_header)
-        response = self.send_data_wait_for_response(command)
+        command = self.build_command('load_segment_header', segment_header)
+        response = self.send_data_wait_for_response(command, with_payload=True)
         if self.is_response_ok(response):
-            return response[2:]
+            return self.get_payload(response)
 
     def load_segment_data(self, segment_data):
         """Send "load_segment_data" command to MCU.
@@ -196,8 +887,8 @@ class BLProtocol:
         dlen = len(segment_data)
         if dlen > 4096:
             raise ValueError("Segment_data can't be longer than 4096 bytes")
-        command = (self.cmd_id['load_segment_data']
-                   + b'\x00' + dlen.to_bytes(2, 'little') + segment_data)
+        self.tx_view[4:4 + dlen] = segment_data
+        command = self.build_load_segment_data(dlen)
         response = self.send_data_wait_for_response(command)
         return self.is_response_ok(response)
 
@@ -209,7 +900,7 @@ class BLProtocol:
         """
 
         logging.debug("CheckImage command")
-        command = self.cmd_id['check_image'] + b'\x00\x00\x00'
+        command = self.build_command('check_image')
         response = self.send_data_wait_for_response(command)
         return self.is_response_ok(response)
 
@@ -220,7 +911,8 @@ class BLProtocol:
             unknown (bytearray): IDK what is it (?).
         """
         logging.debug("MemoryWrite command")
-        command = self.cmd_id['mem_write'] + b'\x00\x08\x00' + unknown
+        command = self.build_command('mem_write', unknown)
+        self.record_command(command, with_response = False)
         self.interface.send_data(command)
         #response = self.send_data_wait_for_response(command)
         #return self.is_response_ok(response)
@@ -233,36 +925,76 @@ class BLProtocol:
         """
 
         logging.debug("ReadJedecId command")
-        command = self.cmd_id['read_jedecid'] + b'\x00\x00\x00'
-        response = self.send_data_wait_for_response(command)
+        command = self.build_command('read_jedecid')
+        response = self.send_data_wait_for_response(command, with_payload=True)
         if self.is_response_ok(response):
-            return response[2:]
+            return self.get_payload(response)
 
-    def flash_erase(self, start_addr, end_addr):
+    def flash_erase(self, start_addr, end_addr, timeout = None,
+                    progress = None, expected_time = None):
         """Erase MCU's given flash memory region.
 
         Args:
             start_addr (int): Starting address for memory erasing.
             end_addr (int): Ending address for memory erasing.
+            timeout (float): Max time of whole erase, given in seconds.
+                None means timeout scaled by amount of sectors.
+            progress (callable): Called with Progress on every PD response.
+                MCU doesn't report erased amount, so it's estimated from
+                elapsed time.
+            expected_time (float): Predicted erase time used for progress,
+                given in seconds. None means sector by sector estimate.
 
         Returns:
             bool: True if operation was succesful.
+
+        Raises:
+            ResponseTimeoutError: If erase didn't finish in time.
         """
 
         logging.debug("FlashErase command")
-        data = (b'\x08\x00'
-                + start_addr.to_bytes(4, 'little')
-                + end_addr.to_bytes(4, 'little'))
-        checksum = self.calc_checksum(data)
-        command = (self.cmd_id['flash_erase']
-                   + checksum.to_bytes(1, 'little') + data)
-        response = self.send_data_wait_for_response(command, 1)
-        while True:
-            response = self.get_response()
-            if response[0:2] == b'PD':
-                print("Pending...")
-            if response[0:2] == b'OK':
-                return True
+        if timeout is None:
+            timeout = self.erase_timeout(start_addr, end_addr)
+        if expected_time is None:
+            expected_time = self.erase_time(start_addr, end_addr)
+        meter = None
+        if progress is not None:
+            meter = ProgressMeter(progress, 'erase', end_addr - start_addr + 1)
+        return self.__wait_erase(self.build_flash_erase(start_addr, end_addr),
+                                 timeout, meter, expected_time)
+
+    def flash_chip_erase(self, timeout):
+        """Erase whole MCU's flash memory.
+
+        Args:
+            timeout (float): Max time of whole erase, given in seconds.
+
+        Returns:
+            bool: True if operation was succesful.
+
+        Raises:
+            ResponseTimeoutError: If erase didn't finish in time.
+        """
+
+        logging.debug("FlashChipErase command")
+        command = self.build_command('flash_chip_erase')
+        return self.__wait_erase(command, timeout)
+
+    def __wait_erase(self, command, timeout, meter = None, expected_time = 0):
+        # PD responses don't extend the deadline of whole erase
+        start = time.monotonic()
+        deadline = start + timeout
+        self.send_command(command)
+        response = self.get_response(max(0, deadline - time.monotonic()))
+        while response[0:2] == b'PD':
+            logging.debug("Pending...")
+            self.report_erase_progress(meter, time.monotonic() - start,
+                                       expected_time)
+            response = self.get_response(max(0, deadline - time.monotonic()))
+        result = self.is_response_ok(response)
+        if meter is not None:
+            meter.update(meter.total)
+        return result
 
     def flash_write(self, start_addr, payload):
         """Write MCU's flash memory region with given payload.
@@ -282,13 +1014,10 @@ class BLProtocol:
         dlen = len(payload)
         if dlen > 8000:
             raise ValueError("Payload can't be longer than 8000 bytes")
-        data = ((dlen + 4).to_bytes(2, 'little')
-                + start_addr.to_bytes(4, 'little')
-                + payload)
-        checksum = self.calc_checksum(data)
-        command = (self.cmd_id['flash_write']
-                   + checksum.to_bytes(1, 'little') + data)
-        response = self.send_data_wait_for_response(command)
+        self.tx_view[8:8 + dlen] = payload
+        command = self.build_flash_write(start_addr, dlen)
+        response = self.send_data_wait_for_response(command,
+                                                    self.write_timeout(dlen))
         return self.is_response_ok(response)
 
     def flash_write_check(self):
@@ -299,48 +1028,175 @@ class BLProtocol:
         """
 
         logging.debug("FlashWriteCheck command")
-        command = self.cmd_id['flash_write_check'] + b'\x00\x00\x00'
+        command = self.build_command('flash_write_check')
         response = self.send_data_wait_for_response(command)
         return self.is_response_ok(response)
 
     def xip_read_start(self):
 
         logging.debug("XipReadStart command")
-        command = self.cmd_id['xip_read_start'] + b'\x00\x00\x00'
+        command = self.build_command('xip_read_start')
         response = self.send_data_wait_for_response(command)
         return self.is_response_ok(response)
 
-    def flash_xip_readsha(self, unknown):
+    def flash_xip_readsha(self, start_addr, length):
+        """Read SHA-256 of MCU's flash memory region through XIP.
+
+        Has to be surrounded with "xip_read_start" and "xip_read_finish".
+
+        Args:
+            start_addr (int): Starting address of the region.
+            length (int): Length of the region in bytes.
+
+        Returns:
+            bytearray: SHA-256 digest of the region.
+        """
+
         logging.debug("XipReadSha command")
-        command = self.cmd_id['flash_xip_readsha'] + unknown
-        response = self.send_data_wait_for_response(command)
+        data = start_addr.to_bytes(4, 'little') + length.to_bytes(4, 'little')
+        command = self.build_command('flash_xip_readsha', data, checksum = True)
+        response = self.send_data_wait_for_response(command, with_payload=True)
         if self.is_response_ok(response):
-            return response[2:]
+            return self.get_payload(response)
 
     def xip_read_finish(self):
         logging.debug("XipReadFinish command")
-        command = self.cmd_id['xip_read_finish'] + b'\x00\x00\x00'
+        command = self.build_command('xip_read_finish')
         response = self.send_data_wait_for_response(command)
         return self.is_response_ok(response)
 
-    def load_full_data(self, file):
+    def load_full_data(self, data, progress = None):
+        """Send data to MCU split into "load_segment_data" commands.
+
+        Args:
+            data (bytes-like): Data to send, e.g. slice of BLImage.
+            progress (callable): Called with Progress after every chunk.
+        """
+
         logging.debug("LoadFullData Procedure")
-        data = file.read(4080)
-        while len(data) > 0:
-            self.load_segment_data(data)
-            data = file.read(4080)
+        view = memoryview(data)
+        meter = None
+        if progress is not None:
+            meter = ProgressMeter(progress, 'load', len(view))
+        for offset in range(0, len(view), 4080):
+            chunk = view[offset:offset + 4080]
+            self.tx_view[4:4 + len(chunk)] = chunk
+            response = self.send_data_wait_for_response(
+                self.build_load_segment_data(len(chunk)))
+            self.is_response_ok(response)
+            if meter is not None:
+                meter.update(offset + len(chunk))
+
+    def flash_write_all(self, start_addr, data, chunk_size = 4096,
+                        window = 1, skip_erased = True, progress = None):
+        """Write data into MCU's flash memory.
+
+        With window bigger than 1, next commands are sent before previous
+        ones are acknowledged, so link doesn't stay idle while MCU programs
+        flash. Responses are matched with chunks in order of sending.
+
+        Region has to be erased beforehand. Erase isn't interleaved with
+        writes, as eflash loader runs commands one by one over single UART,
+        so it can't erase while programming and queueing erases behind
+        writes would only hide a round trip per erase.
+
+        Chunks consisting only of 0xFF are not sent, as programming them
+        can't change erased flash. They are still included in SHA.
+
+        Args:
+            start_addr (int): Starting address for memory writing.
+            data (bytes-like): Data to write, e.g. slice of BLImage.
+            chunk_size (int): Payload size of a single "flash_write" command.
+            window (int): Max number of unacknowledged "flash_write" commands.
+            skip_erased (bool): Don't send chunks consisting only of 0xFF.
+            progress (callable): Called with Progress after every chunk,
+                bytes done are counted when chunk is sent.
+
+        Returns:
+            bytes: SHA-256 digest of written data.
+
+        Raises:
+            BLBootProtocolError: First error reported by MCU, commands which
+                are already in flight are collected before raising.
+        """
 
-    def flash_write_all(self, start_addr, file):
         logging.debug("FlashWriteFull Procedure")
-        data = file.read(2048)
-        while len(data) > 0:
-            self.flash_write(start_addr, data)
-            start_addr = start_addr + len(data)
-            data = file.read(2048)
+        pipeline = BLWritePipeline(self, chunk_size, window, progress,
+                                   len(data))
+        return self.__run_pipeline(pipeline, pipeline.write(start_addr, data,
+                                                            skip_erased))
+
+    def flash_decompress_write_all(self, start_addr, data, chunk_size = 4096,
+                                   window = 1, progress = None):
+        """Write data into MCU's flash memory in XZ compressed form.
+
+        Data is compressed on the fly and eflash loader expands it into
+        flash. Region has to be erased beforehand.
+
+        Args:
+            start_addr (int): Starting address for memory writing.
+            data (bytes-like): Data to write, e.g. slice of BLImage.
+            chunk_size (int): Compressed payload size of a single command.
+            window (int): Max number of unacknowledged commands.
+            progress (callable): Called with Progress after every chunk,
+                bytes done are uncompressed bytes estimated from compression
+                ratio.
+
+        Returns:
+            bytes: SHA-256 digest of uncompressed data.
+
+        Raises:
+            IdError: If eflash loader doesn't support compressed writes.
+            BLBootProtocolError: First error reported by MCU, commands which
+                are already in flight are collected before raising.
+        """
+
+        logging.debug("FlashDecompressWriteFull Procedure")
+        pipeline = BLWritePipeline(self, chunk_size, window, progress,
+                                   len(data))
+        return self.__run_pipeline(pipeline,
+                                   pipeline.decompress_write(start_addr, data))
+
+    def __run_pipeline(self, pipeline, commands):
+        """Send commands of pipeline and collect their responses.
+
+        Args:
+            pipeline (BLWritePipeline): State of the procedure.
+            commands (iterator): Command frames generated by pipeline.
+
+        Returns:
+            bytes: SHA-256 digest of written data.
+        """
+
+        try:
+            for command in commands:
+                self.send_command(command)
+                while pipeline.full():
+                    self.__acknowledge(pipeline)
+            while pipeline.in_flight:
+                self.__acknowledge(pipeline)
+        except bl_errors.ResponseTimeoutError:
+            pipeline.fail()
+            raise
+        except bl_errors.BLBootProtocolError:
+            # Keep RX stream in sync with commands before giving up, first
+            # error reported by MCU is raised
+            for timeout in pipeline.fail():
+                try:
+                    self.get_final_response(time.monotonic() + timeout)
+                except bl_errors.ResponseTimeoutError:
+                    break
+            raise
+        return pipeline.finish()
+
+    def __acknowledge(self, pipeline):
+        response = self.get_final_response(time.monotonic()
+                                           + pipeline.timeout())
+        pipeline.acknowledge(response)
 
     def efuse_read_mac_addr(self):
         logging.debug("EfuseReadMacAddr command")
-        command = self.cmd_id['efuse_read_mac_addr'] + b'\x00\x00\x00'
-        response = self.send_data_wait_for_response(command)
+        command = self.build_command('efuse_read_mac_addr')
+        response = self.send_data_wait_for_response(command, with_payload=True)
         if self.is_response_ok(response):
-            return response[2:]
+            return self.get_payload(response)
@@ -0,0 +1,634 @@
+"""This module contains simulated BL702 with ISP bootloader and eflash loader,
+so flashing can be developed and benchmarked without hardware.
+
+Simulated MCU is reached through "sim://" port, opened by
+serial.serial_for_url() once bl_url_handlers is registered (main.py and
+multi_flash.py do it):
+
+    python main.py --port sim://dev0 --firmware samples/helloworld/project.bin
+
+Options are given as URL query, e.g. sim://dev0?time_scale=0.1:
+    time_scale  - multiplier of flash erase/program times (default 1.0)
+    flash_size  - flash size in bytes (default 2 MB)
+    decompress  - 0 emulates eflash loader without compressed writes
+
+Devices are kept per URL for the lifetime of the process, so flash content
+and running eflash loader survive reopening the port.
+
+Model:
+    - UART moves 10 bits per byte in both directions, data sent at baudrate
+      other than MCU's one is lost
+    - MCU handles commands one by one, data waiting for it is kept in RX
+      buffer of limited size, commands which don't fit are lost
+    - erase/program times are taken from SpiFlashCfg, long operations report
+      progress with PD responses
+    - errors are reported with FL codes of bl_errors exceptions
+    - BOOT and ENABLE pins are driven by RTS and DTR, as on typical fixture
+
+"""
+
+import collections
+import hashlib
+import heapq
+import itertools
+import logging
+import lzma
+import threading
+import time
+import urllib.parse
+
+import bl_errors
+from bl_erase import BLErasePlanner
+from bootinfo import BootInfo
+
+DEFAULT_BOOTINFO_PATH = 'utils/bootinfo.cfg'
+
+# MCU side timing, in seconds
+CMD_OVERHEAD = 0.0002
+PENDING_INTERVAL = 0.1
+LOADER_BOOT_TIME = 0.02
+# SHA is calculated over data read through XIP, in bytes per second
+XIP_READ_RATE = 4_000_000
+RX_BUFFER_SIZE = 16 * 1024
+
+# Writing value with this bit into this register starts loaded image
+BOOT_REG_ADDR = 0x40000018
+BOOT_REG_RUN = 0x02
+
+COMMANDS = {
+    0x10 : 'get_boot_info',
+    0x11 : 'load_boot_header',
+    0x17 : 'load_segment_header',
+    0x18 : 'load_segment_data',
+    0x19 : 'check_image',
+    0x50 : 'mem_write',
+    0x36 : 'read_jedecid',
+    0x30 : 'flash_erase',
+    0x31 : 'flash_write',
+    0x3A : 'flash_write_check',
+    0x60 : 'xip_read_start',
+    0x3E : 'flash_xip_readsha',
+    0x61 : 'xip_read_finish',
+    0x42 : 'efuse_read_mac_addr',
+    0x20 : 'change_rate',
+    0x3C : 'flash_chip_erase',
+    0x3F : 'flash_decompress_write',
+}
+
+ROM_COMMANDS = {
+    'get_boot_info',
+    'load_boot_header',
+    'load_segment_header',
+    'load_segment_data',
+    'check_image',
+    'mem_write',
+}
+
+LOADER_COMMANDS = set(COMMANDS.values()) - {
+    'load_boot_header',
+    'load_segment_header',
+    'load_segment_data',
+    'check_image',
+}
+
+# Commands which checksum is verified by MCU
+CHECKSUM_COMMANDS = {
+    'change_rate',
+    'flash_erase',
+    'flash_write',
+    'flash_xip_readsha',
+    'flash_decompress_write',
+}
+
+
+def error_code(error):
+    """Get FL code of given error.
+
+    Args:
+        error (type): Exception class from bl_errors aggregators.
+
+    Returns:
+        bytes: Error code, LSB first.
+    """
+
+    for msb, errors in enumerate(bl_errors.errors_agregator):
+        if error in errors:
+            return bytes([errors.index(error) + 1, msb])
+    raise ValueError(f"{error.__name__} has no error code")
+
+
+class BLSimDevice:
+    def __init__(self, flash_cfg = None, flash_size = 2 * 1024 * 1024,
+                 time_scale = 1.0, decompress = True):
+        """
+        Args:
+            flash_cfg (SpiFlashCfg): Flash configuration, None means the one
+                from utils/bootinfo.cfg.
+            flash_size (int): Flash size in bytes.
+            time_scale (float): Multiplier of flash erase/program times.
+            decompress (bool): Support "flash_decompress_write" command.
+        """
+
+        if flash_cfg is None:
+            flash_cfg = BootInfo(DEFAULT_BOOTINFO_PATH).bootheader.flash_cfg.cfg
+
+        self.flash = bytearray(b'\xff') * flash_size
+        self.time_scale = time_scale
+        self.decompress = decompress
+        self.erase_planner = BLErasePlanner(flash_cfg)
+        # Sizes are given in KB and bytes, times in milliseconds
+        self.sector_size = flash_cfg.sector_size * 1024
+        self.page_size = flash_cfg.page_size
+        self.page_program_time = flash_cfg.page_program_time / 1000
+
+        self.boot_info = bytes.fromhex('01000000') + bytes(16)
+        self.jedecid = bytes.fromhex('c8401500')
+        self.mac_addr = bytes.fromhex('b40ecf000001')
+
+        self.handlers = {
+            'get_boot_info' : self.__get_boot_info,
+            'load_boot_header' : self.__load_boot_header,
+            'load_segment_header' : self.__load_segment_header,
+            'load_segment_data' : self.__load_segment_data,
+            'check_image' : self.__check_image,
+            'mem_write' : self.__mem_write,
+            'read_jedecid' : self.__read_jedecid,
+            'flash_erase' : self.__flash_erase,
+            'flash_write' : self.__flash_write,
+            'flash_write_check' : self.__flash_write_check,
+            'xip_read_start' : self.__xip_read_start,
+            'flash_xip_readsha' : self.__flash_xip_readsha,
+            'xip_read_finish' : self.__xip_read_finish,
+            'efuse_read_mac_addr' : self.__efuse_read_mac_addr,
+            'change_rate' : self.__change_rate,
+            'flash_chip_erase' : self.__flash_chip_erase,
+            'flash_decompress_write' : self.__flash_decompress_write,
+        }
+
+        # Pins are pulled, so MCU is powered and runs its application
+        self.boot_pin = False
+        self.state = 'app'
+        self.__power_on()
+
+    def __power_on(self):
+        self.state = 'rom' if self.boot_pin else 'app'
+        # Bootloader detects baudrate from handshake
+        self.baudrate = None
+        self.next_baudrate = None
+        self.ready_at = 0.0
+        self.busy_until = 0.0
+        self.rx_buffer = bytearray()
+        self.rx_queued = collections.deque()
+
+        self.boot_header = None
+        self.segment_len = None
+        self.segment_data = bytearray()
+        self.image_checked = False
+        self.xip = False
+        self.xz = None
+        self.xz_next = None
+        self.xz_out = None
+
+    def set_pins(self, boot, en):
+        """Put BOOT and ENABLE pins into given state.
+
+        MCU is held in reset while ENABLE is low and boots when it goes high,
+        into ISP bootloader if BOOT is high.
+
+        Args:
+            boot (bool): State of BOOT pin.
+            en (bool): State of ENABLE pin.
+
+        Returns:
+            bool: True if MCU went into reset.
+        """
+
+        self.boot_pin = boot
+        if not en:
+            if self.state == 'off':
+                return False
+            logging.debug("Simulated MCU in reset")
+            self.state = 'off'
+            return True
+        if self.state == 'off':
+            self.__power_on()
+            logging.debug(f"Simulated MCU booted into {self.state}")
+        return False
+
+    def tx_time(self, size):
+        """Time needed to transfer given amount of bytes, in seconds."""
+
+        return size * 10 / self.baudrate
+
+    def receive(self, data, baudrate, arrival):
+        """Feed MCU with data received over UART.
+
+        Args:
+            data (bytes): Received data.
+            baudrate (int): Baudrate data was sent at.
+            arrival (float): Time the last byte arrived, on monotonic clock.
+
+        Returns:
+            list: Responses, as tuples of time the last byte leaves MCU
+                and the data.
+        """
+
+        if self.state not in ('rom', 'loader') or arrival < self.ready_at:
+            return []
+        if self.baudrate is not None and baudrate != self.baudrate:
+            logging.debug(f"Simulated MCU at {self.baudrate} baud dropped "
+                          f"{len(data)} bytes sent at {baudrate} baud")
+            self.rx_buffer.clear()
+            return []
+
+        self.rx_buffer += data
+        responses = []
+        while self.rx_buffer:
+            # Burst of sync bytes is answered once
+            if self.rx_buffer[0] == 0x55:
+                sync_len = len(self.rx_buffer) - len(self.rx_buffer.lstrip(b'\x55'))
+                del self.rx_buffer[:sync_len]
+                if self.baudrate is None:
+                    self.baudrate = baudrate
+                responses += self.__process(None, b'', arrival)
+                continue
+
+            if len(self.rx_buffer) < 4:
+                break
+            dlen = int.from_bytes(self.rx_buffer[2:4], 'little')
+            if len(self.rx_buffer) < 4 + dlen:
+                break
+            frame = bytes(self.rx_buffer[:4 + dlen])
+            del self.rx_buffer[:4 + dlen]
+            responses += self.__process(frame[0], frame, arrival)
+            # Data received together with command starting eflash loader
+            # is lost while it boots
+            if arrival < self.ready_at:
+                self.rx_buffer.clear()
+                break
+        return responses
+
+    def __process(self, cmd, frame, arrival):
+        """Execute single command.
+
+        Returns:
+            list: Responses, see receive().
+        """
+
+        start = max(arrival, self.busy_until)
+
+        # Commands wait in RX buffer until MCU gets to them
+        while self.rx_queued and self.rx_queued[0][0] <= arrival:
+            self.rx_queued.popleft()
+        queued = sum(size for _, size in self.rx_queued)
+        if queued + len(frame) > RX_BUFFER_SIZE:
+            logging.warning(f"Simulated MCU RX buffer overflow, "
+                            f"{len(frame)} bytes lost")
+            return []
+        if start > arrival:
+            self.rx_queued.append((start, len(frame)))
+
+        if cmd is None:
+            op_time, response = 0.0, b'OK'
+        else:
+            op_time, response = self.__execute(cmd, frame, start)
+
+        finish = start + CMD_OVERHEAD + op_time
+        self.busy_until = finish
+        responses = []
+        pending = start + PENDING_INTERVAL
+        while pending < finish:
+            responses.append((pending + self.tx_time(2), b'PD'))
+            pending += PENDING_INTERVAL
+        if response is not None:
+            responses.append((finish + self.tx_time(len(response)), response))
+
+        # New baudrate is used once response is out
+        if self.next_baudrate is not None:
+            self.baudrate = self.next_baudrate
+            self.next_baudrate = None
+        return responses
+
+    def __execute(self, cmd, frame, start):
+        """Run handler of the command.
+
+        Returns:
+            tuple: Operation time in seconds and response, None if MCU
+                doesn't respond.
+        """
+
+        name = COMMANDS.get(cmd)
+        allowed = ROM_COMMANDS if self.state == 'rom' else LOADER_COMMANDS
+        try:
+            if name not in allowed:
+                raise bl_errors.IdError()
+            if (name in CHECKSUM_COMMANDS
+                    and frame[1] != sum(frame[2:]) & 0xFF):
+                raise bl_errors.CrcError()
+            return self.handlers[name](frame[4:], start)
+        except bl_errors.BLBootProtocolError as e:
+            logging.debug(f"Simulated MCU failed {name or hex(cmd)}: {e!r}")
+            return 0.0, b'FL' + error_code(type(e))
+
+    @staticmethod
+    def __ok(payload = None):
+        if payload is None:
+            return b'OK'
+        return b'OK' + len(payload).to_bytes(2, 'little') + payload
+
+    @staticmethod
+    def __unpack(payload, fields):
+        """Split payload into little endian 32 bit fields."""
+
+        if len(payload) != 4 * fields:
+            raise bl_errors.LenError()
+        return [int.from_bytes(payload[i:i + 4], 'little')
+                for i in range(0, len(payload), 4)]
+
+    def __program(self, addr, data):
+        """Program flash, bits can only go from 1 to 0.
+
+        Returns:
+            float: Programming time in seconds.
+        """
+
+        dlen = len(data)
+        if dlen == 0:
+            return 0.0
+        if addr + dlen > len(self.flash):
+            raise bl_errors.WriteAddrError()
+        old = int.from_bytes(self.flash[addr:addr + dlen], 'big')
+        new = int.from_bytes(data, 'big')
+        self.flash[addr:addr + dlen] = (old & new).to_bytes(dlen, 'big')
+        pages = ((addr + dlen - 1) // self.page_size
+                 - addr // self.page_size + 1)
+        return pages * self.page_program_time * self.time_scale
+
+    # ISP bootloader
+    ############################################################################
+    def __get_boot_info(self, payload, start):
+        return 0.0, self.__ok(self.boot_info)
+
+    def __load_boot_header(self, payload, start):
+        if len(payload) != 176:
+            raise bl_errors.BootHeaderLenError()
+        if payload[:4] != b'BFNP':
+            raise bl_errors.BootHeaderMagicError()
+        self.boot_header = payload
+        self.segment_len = None
+        self.image_checked = False
+        return 0.0, self.__ok()
+
+    def __load_segment_header(self, payload, start):
+        if self.boot_header is None:
+            raise bl_errors.BootHeaderNotLoadError()
+        if len(payload) != 16:
+            raise bl_errors.LenError()
+        self.segment_len = int.from_bytes(payload[4:8], 'little')
+        self.segment_data = bytearray()
+        return 0.0, self.__ok(payload)
+
+    def __load_segment_data(self, payload, start):
+        if self.segment_len is None:
+            raise bl_errors.SegmentCntError()
+        if len(self.segment_data) + len(payload) > self.segment_len:
+            raise bl_errors.LenError()
+        self.segment_data += payload
+        return 0.0, self.__ok()
+
+    def __check_image(self, payload, start):
+        if self.boot_header is None:
+            raise bl_errors.BootHeaderNotLoadError()
+        if self.segment_len is None or len(self.segment_data) != self.segment_len:
+            raise bl_errors.SegmentCntError()
+        self.image_checked = True
+        return 0.0, self.__ok()
+
+    def __mem_write(self, payload, start):
+        addr, value = self.__unpack(payload, 2)
+        if (self.state == 'rom' and self.image_checked
+                and addr == BOOT_REG_ADDR and value & BOOT_REG_RUN):
+            logging.debug("Simulated MCU starts eflash loader")
+            self.state = 'loader'
+            self.ready_at = start + CMD_OVERHEAD + LOADER_BOOT_TIME
+        # Host doesn't wait for response
+        return 0.0, None
+
+    # Eflash loader
+    ############################################################################
+    def __read_jedecid(self, payload, start):
+        return 0.0, self.__ok(self.jedecid)
+
+    def __efuse_read_mac_addr(self, payload, start):
+        return 0.0, self.__ok(self.mac_addr)
+
+    def __change_rate(self, payload, start):
+        _, new_baudrate = self.__unpack(payload, 2)
+        self.next_baudrate = new_baudrate
+        return 0.0, self.__ok()
+
+    def __flash_erase(self, payload, start):
+        start_addr, end_addr = self.__unpack(payload, 2)
+        if start_addr > end_addr or end_addr >= len(self.flash):
+            raise bl_errors.EraseParaError()
+        _, erase_time = self.erase_planner.plan(start_addr, end_addr)
+        first = start_addr // self.sector_size * self.sector_size
+        last = (end_addr // self.sector_size + 1) * self.sector_size
+        self.flash[first:last] = b'\xff' * (last - first)
+        return erase_time * self.time_scale, self.__ok()
+
+    def __flash_chip_erase(self, payload, start):
+        self.flash[:] = b'\xff' * len(self.flash)
+        return (self.erase_planner.chip_erase_time * self.time_scale,
+                self.__ok())
+
+    def __flash_write(self, payload, start):
+        if len(payload) < 4:
+            raise bl_errors.WriteParaError()
+        addr = int.from_bytes(payload[:4], 'little')
+        return self.__program(addr, payload[4:]), self.__ok()
+
+    def __flash_decompress_write(self, payload, start):
+        if not self.decompress:
+            raise bl_errors.IdError()
+        if len(payload) < 4:
+            raise bl_errors.WriteParaError()
+        addr = int.from_bytes(payload[:4], 'little')
+        data = payload[4:]
+
+        # Address follows compressed stream, anything else starts a new one
+        if self.xz is None or addr != self.xz_next:
+            self.xz = lzma.LZMADecompressor(format = lzma.FORMAT_XZ)
+            self.xz_out = addr
+        self.xz_next = addr + len(data)
+        try:
+            output = self.xz.decompress(data)
+        except lzma.LZMAError:
+            self.xz = None
+            raise bl_errors.WriteError() from None
+
+        op_time = self.__program(self.xz_out, output)
+        self.xz_out += len(output)
+        if self.xz.eof:
+            self.xz = None
+        return op_time, self.__ok()
+
+    def __flash_write_check(self, payload, start):
+        return 0.0, self.__ok()
+
+    def __xip_read_start(self, payload, start):
+        self.xip = True
+        return 0.0, self.__ok()
+
+    def __flash_xip_readsha(self, payload, start):
+        start_addr, length = self.__unpack(payload, 2)
+        if not self.xip or start_addr + length > len(self.flash):
+            raise bl_errors.SetParaError()
+        sha = hashlib.sha256(self.flash[start_addr:start_addr + length])
+        return length / XIP_READ_RATE, self.__ok(sha.digest())
+
+    def __xip_read_finish(self, payload, start):
+        self.xip = False
+        return 0.0, self.__ok()
+
+
+class SimSerial:
+    """Subset of pyserial's Serial API connected to simulated MCU.
+
+    Like pyserial's Serial, port is opened right away when given, otherwise
+    it has to be set and opened later (as serial.serial_for_url() does).
+
+    Args:
+        port (str): Port URL, sim://<name>[?<options>], see module docstring.
+        baudrate (int): Host baudrate.
+        timeout (float): Read timeout, given in seconds.
+    """
+
+    def __init__(self, port = None, baudrate = 9600, timeout = None,
+                 **kwargs):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.is_open = False
+        self.device = None
+        # None - not driven yet
+        self.signals = {'RTS' : None, 'DTR' : None}
+
+        self.lock = threading.Condition()
+        self.rx_buffer = bytearray()
+        # Heap of (due time, sequence, data) of responses on the line
+        self.responses = []
+        self.sequence = itertools.count()
+        self.tx_free_at = 0.0
+
+        if port is not None:
+            self.open()
+
+    def open(self):
+        self.device = get_device(self.port)
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.port).query)
+        self.boot_signal = query.get('boot', ['RTS'])[0]
+        self.en_signal = query.get('en', ['DTR'])[0]
+        self.is_open = True
+
+    def write(self, data):
+        with self.lock:
+            start = max(time.monotonic(), self.tx_free_at)
+            self.tx_free_at = start + len(data) * 10 / self.baudrate
+            for due, response in self.device.receive(bytes(data), self.baudrate,
+                                                     self.tx_free_at):
+                heapq.heappush(self.responses,
+                               (due, next(self.sequence), response))
+            self.lock.notify_all()
+        return len(data)
+
+    def read(self, size = 1):
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.__collect(now)
+                if self.rx_buffer or not self.is_open:
+                    break
+                wait = None
+                if deadline is not None:
+                    wait = deadline - now
+                    if wait <= 0:
+                        break
+                if self.responses:
+                    due = self.responses[0][0] - now
+                    wait = due if wait is None else min(wait, due)
+                self.lock.wait(wait)
+
+            data = bytes(self.rx_buffer[:size])
+            del self.rx_buffer[:size]
+        return data
+
+    @property
+    def in_waiting(self):
+        with self.lock:
+            self.__collect(time.monotonic())
+            return len(self.rx_buffer)
+
+    def __collect(self, now):
+        """Move responses which reached host into RX buffer."""
+
+        while self.responses and self.responses[0][0] <= now:
+            self.rx_buffer += heapq.heappop(self.responses)[2]
+
+    def setRTS(self, state):
+        self.__set_signal('RTS', state)
+
+    def setDTR(self, state):
+        self.__set_signal('DTR', state)
+
+    def __set_signal(self, signal, state):
+        with self.lock:
+            self.signals[signal] = state
+            # Asserted signal drives the line low, undriven BOOT is pulled
+            # down and ENABLE up
+            boot = self.signals[self.boot_signal] is False
+            en = self.signals[self.en_signal] is not True
+            if self.device.set_pins(boot, en):
+                self.responses.clear()
+                self.rx_buffer.clear()
+
+    def close(self):
+        with self.lock:
+            self.is_open = False
+            self.lock.notify_all()
+
+
+_devices = {}
+_devices_lock = threading.Lock()
+
+def get_device(url):
+    """Get simulated MCU behind given URL, it is created on first use.
+
+    Args:
+        url (str): Port URL, sim://<name>[?<options>].
+
+    Returns:
+        BLSimDevice: Simulated MCU.
+    """
+
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme != 'sim':
+        raise ValueError(f"Not a simulator URL: {url}")
+    query = urllib.parse.parse_qs(parts.query)
+    options = {}
+    if 'time_scale' in query:
+        options['time_scale'] = float(query['time_scale'][0])
+    if 'flash_size' in query:
+        options['flash_size'] = int(query['flash_size'][0], 0)
+    if 'decompress' in query:
+        options['decompress'] = query['decompress'][0] != '0'
+
+    with _devices_lock:
+        name = parts.netloc + parts.path
+        if name not in _devices:
+            _devices[name] = BLSimDevice(**options)
+        return _devices[name]
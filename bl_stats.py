@@ -0,0 +1,170 @@
+"""This module contains BLStats class, which collects per-command statistics
+of ISP protocol traffic.
+
+BLProtocol reports every command and response to BLStats given in its
+constructor. Without it nothing is recorded, so statistics cost a single
+comparison per command.
+
+Collected for every command:
+    commands        - amount of sent commands
+    bytes_sent      - bytes sent, including command header
+    bytes_received  - bytes of final responses
+    errors          - FL responses
+    pending         - PD responses
+    timeouts        - responses which didn't come in time
+    retries         - repeated attempts (e.g. handshakes)
+    latency         - histogram of time from sending the command to its final
+                      response, in seconds
+
+"""
+
+import bisect
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05,
+                   0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+COUNTERS = ['commands', 'bytes_sent', 'bytes_received', 'errors', 'pending',
+            'timeouts', 'retries']
+
+
+class BLCommandStats:
+    __slots__ = COUNTERS + ['latency_buckets', 'latency_sum']
+
+    def __init__(self):
+        for counter in COUNTERS:
+            setattr(self, counter, 0)
+        # Last bucket counts latencies above all bounds
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+
+    @property
+    def latency_count(self):
+        return sum(self.latency_buckets)
+
+    def latency_quantile(self, q):
+        """Estimate latency quantile from histogram.
+
+        Args:
+            q (float): Quantile, in range 0..1.
+
+        Returns:
+            float: Upper bound of bucket holding the quantile, None if
+                nothing was recorded or it falls above all buckets.
+        """
+
+        count = self.latency_count
+        if count == 0:
+            return None
+        rank = q * count
+        seen = 0
+        for bound, bucket in zip(LATENCY_BUCKETS, self.latency_buckets):
+            seen += bucket
+            if seen >= rank:
+                return bound
+        return None
+
+
+class BLStats:
+    def __init__(self, labels = None):
+        """
+        Args:
+            labels (dict): Labels added to exported metrics, e.g. port.
+        """
+
+        self.labels = dict(labels or {})
+        self.commands = {}
+
+    def __getitem__(self, name):
+        """Get statistics of given command, they are created on first use."""
+
+        stats = self.commands.get(name)
+        if stats is None:
+            stats = self.commands[name] = BLCommandStats()
+        return stats
+
+    def command_sent(self, name, size):
+        stats = self[name]
+        stats.commands += 1
+        stats.bytes_sent += size
+
+    def response_received(self, name, size, latency, ok):
+        stats = self[name]
+        stats.bytes_received += size
+        if not ok:
+            stats.errors += 1
+        stats.latency_buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        stats.latency_sum += latency
+
+    def pending(self, name):
+        self[name].pending += 1
+
+    def timeout(self, name):
+        self[name].timeouts += 1
+
+    def retry(self, name, count = 1):
+        self[name].retries += count
+
+    def summary(self):
+        """Format statistics as human readable table.
+
+        Returns:
+            str: One line per command.
+        """
+
+        lines = [f"{'command':<24}{'count':>7}{'sent':>10}{'recv':>8}"
+                 f"{'avg ms':>9}{'p95 ms':>9}{'err':>5}{'pd':>5}"
+                 f"{'t/o':>5}{'retry':>6}"]
+        for name, stats in sorted(self.commands.items()):
+            count = stats.latency_count
+            avg = f"{stats.latency_sum / count * 1000:.2f}" if count else '-'
+            p95 = stats.latency_quantile(0.95)
+            p95 = f"{p95 * 1000:.1f}" if p95 is not None else '-'
+            lines.append(f"{name:<24}{stats.commands:>7}{stats.bytes_sent:>10}"
+                         f"{stats.bytes_received:>8}{avg:>9}{p95:>9}"
+                         f"{stats.errors:>5}{stats.pending:>5}"
+                         f"{stats.timeouts:>5}{stats.retries:>6}")
+        return '\n'.join(lines)
+
+
+def format_labels(labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+    return ','.join(f'{key}="{escape(value)}"' for key, value in labels.items())
+
+def to_prometheus(stats_list, prefix = 'bl_isp'):
+    """Export statistics in Prometheus text format.
+
+    Args:
+        stats_list (list): BLStats instances, told apart by their labels.
+        prefix (str): Prefix of metric names.
+
+    Returns:
+        str: Metrics in Prometheus text exposition format.
+    """
+
+    lines = []
+    for counter in COUNTERS:
+        metric = f"{prefix}_{counter}_total"
+        lines.append(f"# TYPE {metric} counter")
+        for bl_stats in stats_list:
+            for name, stats in sorted(bl_stats.commands.items()):
+                labels = format_labels({**bl_stats.labels, 'command' : name})
+                lines.append(f"{metric}{{{labels}}} {getattr(stats, counter)}")
+
+    metric = f"{prefix}_latency_seconds"
+    lines.append(f"# TYPE {metric} histogram")
+    for bl_stats in stats_list:
+        for name, stats in sorted(bl_stats.commands.items()):
+            labels = {**bl_stats.labels, 'command' : name}
+            cumulative = 0
+            for bound, bucket in zip(LATENCY_BUCKETS + ('+Inf',),
+                                     stats.latency_buckets):
+                cumulative += bucket
+                bucket_labels = format_labels({**labels, 'le' : bound})
+                lines.append(f"{metric}_bucket{{{bucket_labels}}} {cumulative}")
+            lines.append(f"{metric}_sum{{{format_labels(labels)}}} "
+                         f"{stats.latency_sum}")
+            lines.append(f"{metric}_count{{{format_labels(labels)}}} "
+                         f"{cumulative}")
+    return '\n'.join(lines) + '\n'
@@ -1,69 +1,55 @@
 import serial
-import queue
 import time
 import logging
 import threading
 
-class BLUart:
-    def __init__(self,
-                 port = '/dev/ttyUSB0',
-                 baudrate = 500_000,
-                 boot_pin = 'RTS',
-                 boot_pin_inverted = True,
-                 en_pin = 'DTR',
-                 en_pin_inverted = True):
+class BLUartBase:
+    """Serial port with BOOT and ENABLE pins, shared by BLUart and
+    AsyncBLUart. Subclasses add RX handling and pin sequences.
+    """
+
+    def __init__(self, port, baudrate, boot_pin, boot_pin_inverted, en_pin,
+                 en_pin_inverted, boot_time, reset_time, timeout):
 
         # Config and open serial connection
-        self.uart = serial.Serial(port,
-                                  baudrate,
-                                  bytesize = serial.EIGHTBITS,
-                                  parity = serial.PARITY_NONE,
-                                  stopbits = serial.STOPBITS_ONE,
-                                  timeout = 2)
+        self.uart = serial.serial_for_url(port,
+                                          baudrate,
+                                          bytesize = serial.EIGHTBITS,
+                                          parity = serial.PARITY_NONE,
+                                          stopbits = serial.STOPBITS_ONE,
+                                          timeout = timeout)
 
         # Define boot/enable GPIO connections
         self.boot_pin = boot_pin
         self.boot_pin_inverted = boot_pin_inverted
         self.en_pin = en_pin
         self.en_pin_inverted = en_pin_inverted
-        self.stop_rx_thread = True
+
+        # Pin timing, depends on fixture wiring (RC delays, level shifters)
+        self.boot_time = boot_time
+        self.reset_time = reset_time
+        self.rx_callback = None
 
         self.pin_switcher = {
             'RTS' : self.uart.setRTS,
             'DTR' : self.uart.setDTR
         }
 
-        self.__rx_thread_start()
+    @property
+    def baudrate(self):
+        """int: Baudrate currently used by host."""
 
-    def send_data(self, data):
-        """Send data over UART.
+        return self.uart.baudrate
+
+    def set_baudrate(self, baudrate):
+        """Reconfigure host side of the link to given baudrate.
 
         Args:
-            data (bytearray): Data to sent.
+            baudrate (int): New baudrate.
         """
 
-        self.uart.write(data)
-
-    def __rx_thread(self):
-        while self.uart.is_open:
-            time.sleep(0.02)
-            len = self.uart.in_waiting
-            if len > 0 and self.rx_callback is not None:
-                self.rx_callback(self.uart.read(len))
-            if self.stop_rx_thread:
-                break   
-
-    def __rx_thread_start(self):
-        self.rx_thread = threading.Thread(target = self.__rx_thread)
-        self.stop_rx_thread = False
-        self.rx_thread.start()
-    
-    def __rx_thread_stop(self):
-        self.stop_rx_thread = True
-        self.rx_thread.join()
-
-    def register_rx_callback(self, rx_callback):
-        self.rx_callback = rx_callback
+        logging.debug(f"Baudrate: {baudrate}")
+        self.uart.baudrate = baudrate
 
     def en_pin_set(self, state):
         """Put ENABLE pin into given state.
@@ -91,19 +77,90 @@ class BLUart:
             state = not state
         self.pin_switcher[self.boot_pin](state)
 
+class BLUart(BLUartBase):
+    def __init__(self,
+                 port = '/dev/ttyUSB0',
+                 baudrate = 500_000,
+                 boot_pin = 'RTS',
+                 boot_pin_inverted = True,
+                 en_pin = 'DTR',
+                 en_pin_inverted = True,
+                 boot_time = 0.05,
+                 reset_time = 0.05):
+
+        # Read timeout only bounds how long RX thread stays blocked before
+        # checking if it should stop
+        super().__init__(port, baudrate, boot_pin, boot_pin_inverted, en_pin,
+                         en_pin_inverted, boot_time, reset_time, timeout = 0.1)
+        self.stop_rx_thread = True
+        self.rx_thread = None
+
+    def send_data(self, data):
+        """Send data over UART.
+
+        Args:
+            data (bytearray): Data to sent.
+        """
+
+        self.uart.write(data)
+
+    def __rx_thread(self):
+        while self.uart.is_open and not self.stop_rx_thread:
+            # Block until first byte arrives, then take everything
+            # which is already buffered
+            data = self.uart.read(1)
+            if not data:
+                continue
+            pending = self.uart.in_waiting
+            if pending > 0:
+                data += self.uart.read(pending)
+            self.rx_callback(data)
+
+    def __rx_thread_start(self):
+        self.rx_thread = threading.Thread(target = self.__rx_thread,
+                                          daemon = True)
+        self.stop_rx_thread = False
+        self.rx_thread.start()
+
+    def __rx_thread_stop(self):
+        if self.rx_thread is None:
+            return
+        self.stop_rx_thread = True
+        self.rx_thread.join()
+        self.rx_thread = None
+
+    def register_rx_callback(self, rx_callback):
+        """Register function called with every chunk of received data.
+
+        RX thread is started with first registered callback.
+
+        Args:
+            rx_callback (callable): Function taking received bytes.
+        """
+
+        self.rx_callback = rx_callback
+        if self.rx_thread is None:
+            self.__rx_thread_start()
+
     def enter_bootloader(self):
-        """Put MCU into bootloader mode."""
+        """Put MCU into bootloader mode.
+
+        BOOT pin is held for boot_time before and after reset, readiness
+        of bootloader has to be checked with handshake.
+        """
 
         logging.info("Entering bootloader.")
         self.boot_pin_set(True)
-        time.sleep(0.5)
+        time.sleep(self.boot_time)
         self.reset()
-        time.sleep(0.5)
+        time.sleep(self.boot_time)
         self.boot_pin_set(False)
 
     def reset(self):
+        """Pull ENABLE pin low for reset_time."""
+
         self.en_pin_set(False)
-        time.sleep(1)
+        time.sleep(self.reset_time)
         self.en_pin_set(True)
 
     def close(self):
@@ -0,0 +1,16 @@
+"""pyserial URL handlers of this project.
+
+After register(), serial.serial_for_url() opens "sim://" ports with simulated
+MCU (see bl_sim). Handler modules are imported only when such URL is opened,
+so real ports don't pay for them.
+
+"""
+
+import serial
+
+
+def register():
+    """Add handlers to pyserial's search path, repeated calls do nothing."""
+
+    if __name__ not in serial.protocol_handler_packages:
+        serial.protocol_handler_packages.append(__name__)
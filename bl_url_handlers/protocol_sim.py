@@ -0,0 +1,5 @@
+"""Handler of "sim://" URLs, see bl_sim."""
+
+from bl_sim import SimSerial as Serial
+
+__all__ = ['Serial']
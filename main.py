@@ -1,13 +1,15 @@
-import os
 import logging
-import time
 import signal
+import sys
 
 from bl_uart import BLUart
 from bl_protocol import BLProtocol
 from args_parser import ArgsParser
 from bl_flasher import BLFlasher
-from bootinfo import BootInfo
+from bl_image import BLImage
+from bl_stats import BLStats, to_prometheus
+from bl_progress import ConsoleProgress
+import bl_url_handlers
     
 
 def config_logging(level = logging.DEBUG):
@@ -28,69 +30,44 @@ def main():
     else:
         config_logging(logging.INFO)
 
+    # Lets sim:// ports reach simulated MCU
+    bl_url_handlers.register()
+
     bl_uart = BLUart(port = args.port,
                      baudrate = args.baudrate,
                      boot_pin = args.bootpin,
-                     en_pin = args.enpin)
-
-    bl_proto = BLProtocol(bl_uart)
-    bl_flasher = BLFlasher(bl_uart)
-
-
-    bl_flasher.connect(2)
-    #Get bootinfo
-    boot_info = bl_proto.get_boot_info()
-    bl_flasher.flash_efloader('chips/bl702/image/eflash_loader/eflash_loader_32m.bin')
-
-    #Unknown operation - these commands are not waiting for response
-    bl_proto.memory_write(b'\x00\xf1\x00\x40\x45\x48\x42\x4e')
-    bl_proto.memory_write(b'\x04\xf1\x00\x40\x00\x00\x01\x22')
-    bl_proto.memory_write(b'\x18\x00\x00\x40\x00\x00\x00\x00')
-    bl_proto.memory_write(b'\x18\x00\x00\x40\x02\x00\x00\x00')
-    time.sleep(0.35)
-
-    bl_proto.handshake()
-    #ReadJedecId
-    mac_addr = bl_proto.efuse_read_mac_addr()
-    logging.info(f"EfuseReadMacAddr response: {mac_addr}")
-
-    #ReadJedecId
-    jedecid = bl_proto.read_jedecid()
-    logging.info(f"ReadJededId response: {jedecid}")
-
-    img_path = args.firmware
-    bin_size = os.path.getsize(img_path)
-
-    bootinfo = BootInfo('utils/bootinfo.cfg')
-    bootinfo.set_img_len(bin_size)
+                     en_pin = args.enpin,
+                     boot_time = args.boottime,
+                     reset_time = args.resettime)
+
+    stats = None
+    if args.stats or args.statsfile:
+        stats = BLStats({'port' : args.port})
+
+    bl_proto = BLProtocol(bl_uart, stats)
+    # Progress line would only clutter logs redirected to file
+    progress = ConsoleProgress() if sys.stderr.isatty() else None
+    bl_flasher = BLFlasher(bl_uart, bl_proto, progress)
+
+
+    bl_flasher.prepare('chips/bl702/image/eflash_loader/eflash_loader_32m.bin',
+                       args.loadbaudrate, args.reuseloader)
+    bl_flasher.read_device_info()
+    with BLImage(args.firmware) as image:
+        bl_flasher.flash_firmware(image, args.addr,
+                                  chunk_size = args.chunksize,
+                                  window = args.window,
+                                  incremental = args.incremental,
+                                  chip_erase = args.chiperase,
+                                  compress = args.compress)
 
-    bl_flasher.flash_img_bootheader(bootinfo.get_bytes())
-
-    #FlashErase
-    start_addr = 0x2000
-    end_addr = 0x2000 + bin_size - 1
-    logging.info(f"Binary size: {bin_size}, start {start_addr}, end {end_addr}")
-    bl_proto.flash_erase(0x2000, end_addr)
-
-    #FlashWrite
-    file = open(img_path, 'rb')
-    bl_proto.flash_write_all(0x2000, file)
-    file.close()
-
-    #FlashWriteCheck
-    bl_proto.flash_write_check()
-
-    #XipReadStart
-    bl_proto.xip_read_start()
-
-    #Unknown operation ??????????
-    sha = bl_proto.flash_xip_readsha(b'\x3D\x08\x00\x00\x20\x00\x00\xC0\x55\x00\x00')
-    logging.info(f"FlashXipReadSha response: {sha}")
-
-    #XipReadStart
-    bl_proto.xip_read_finish()
-    
     logging.info("Flashing finished, Please reset the device")
+
+    if args.stats:
+        print(stats.summary())
+    if args.statsfile:
+        with open(args.statsfile, 'w') as statsfile:
+            statsfile.write(to_prometheus([stats]))
     
     bl_uart.close()
     exit(0)
@@ -0,0 +1,195 @@
+"""Flash the same firmware onto many MCUs at once.
+
+Every port gets its own BLUart/BLProtocol/BLFlasher stack, all of them run
+in one process on a thread pool. With --asyncio,
+AsyncBLUart/AsyncBLProtocol/AsyncBLFlasher stacks are driven by single event
+loop instead.
+
+Usage:
+    python multi_flash.py --ports /dev/ttyUSB0 /dev/ttyUSB1 --firmware img.bin
+
+"""
+
+import time
+import asyncio
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from bl_uart import BLUart
+from bl_protocol import BLProtocol
+from args_parser import ArgsParser
+from bl_flasher import BLFlasher
+from bl_async_uart import AsyncBLUart
+from bl_async_protocol import AsyncBLProtocol
+from bl_async_flasher import AsyncBLFlasher
+from bl_image import BLImage
+from bl_stats import BLStats, to_prometheus
+import bl_url_handlers
+
+EFLASH_LOADER_PATH = 'chips/bl702/image/eflash_loader/eflash_loader_32m.bin'
+
+FlashResult = collections.namedtuple(
+    'FlashResult', ['port', 'mac_addr', 'jedecid', 'sha', 'elapsed', 'error',
+                    'stats'])
+
+
+def config_logging(level = logging.DEBUG):
+    format = '%(levelname)s | %(asctime)s | %(threadName)s ' \
+             '| %(funcName)s() | %(message)s'
+    logging.basicConfig(
+        format=format,
+        level = level)
+
+def flash_device(port, image, args):
+    """Run whole flashing procedure on a single port.
+
+    Args:
+        port (str): Serial port of the device.
+        image (BLImage): Firmware image shared by all devices.
+        args (argparse.Namespace): Parsed command line arguments.
+
+    Returns:
+        FlashResult: Outcome of flashing.
+    """
+
+    threading.current_thread().name = port
+    start = time.monotonic()
+    mac_addr = jedecid = sha = None
+    error = None
+    stats = None
+    if args.stats or args.statsfile:
+        stats = BLStats({'port' : port})
+
+    bl_uart = None
+    try:
+        bl_uart = BLUart(port = port,
+                         baudrate = args.baudrate,
+                         boot_pin = args.bootpin,
+                         en_pin = args.enpin,
+                         boot_time = args.boottime,
+                         reset_time = args.resettime)
+        bl_flasher = BLFlasher(bl_uart, BLProtocol(bl_uart, stats))
+
+        bl_flasher.prepare(EFLASH_LOADER_PATH, args.loadbaudrate,
+                           args.reuseloader)
+        mac_addr, jedecid = bl_flasher.read_device_info()
+        sha = bl_flasher.flash_firmware(image, args.addr,
+                                        chunk_size = args.chunksize,
+                                        window = args.window,
+                                        incremental = args.incremental,
+                                        chip_erase = args.chiperase,
+                                        compress = args.compress)
+    except Exception as e:
+        logging.error(f"Flashing failed: {e!r}")
+        # Live exception would keep frames (and image slices) alive
+        error = repr(e)
+    finally:
+        if bl_uart is not None:
+            bl_uart.close()
+
+    return FlashResult(port, mac_addr, jedecid, sha,
+                       time.monotonic() - start, error, stats)
+
+async def flash_device_async(port, image, args):
+    """Run whole flashing procedure on a single port, as coroutine.
+
+    Args:
+        port (str): Serial port of the device.
+        image (BLImage): Firmware image shared by all devices.
+        args (argparse.Namespace): Parsed command line arguments.
+
+    Returns:
+        FlashResult: Outcome of flashing.
+    """
+
+    start = time.monotonic()
+    mac_addr = jedecid = sha = None
+    error = None
+    stats = None
+    if args.stats or args.statsfile:
+        stats = BLStats({'port' : port})
+
+    bl_uart = None
+    try:
+        bl_uart = AsyncBLUart(port = port,
+                              baudrate = args.baudrate,
+                              boot_pin = args.bootpin,
+                              en_pin = args.enpin,
+                              boot_time = args.boottime,
+                              reset_time = args.resettime)
+        bl_flasher = AsyncBLFlasher(bl_uart, AsyncBLProtocol(bl_uart, stats))
+
+        await bl_flasher.prepare(EFLASH_LOADER_PATH, args.loadbaudrate,
+                                 args.reuseloader)
+        mac_addr, jedecid = await bl_flasher.read_device_info()
+        sha = await bl_flasher.flash_firmware(image, args.addr,
+                                              chunk_size = args.chunksize,
+                                              window = args.window,
+                                              incremental = args.incremental,
+                                              chip_erase = args.chiperase,
+                                              compress = args.compress)
+    except Exception as e:
+        logging.error(f"{port}: Flashing failed: {e!r}")
+        # Live exception would keep frames (and image slices) alive
+        error = repr(e)
+    finally:
+        if bl_uart is not None:
+            await bl_uart.close()
+
+    return FlashResult(port, mac_addr, jedecid, sha,
+                       time.monotonic() - start, error, stats)
+
+async def flash_all_async(ports, image, args):
+    return await asyncio.gather(*(flash_device_async(port, image, args)
+                                  for port in ports))
+
+def print_report(results):
+    for result in results:
+        status = 'OK' if result.error is None else f'FAILED ({result.error})'
+        mac_addr = result.mac_addr.hex() if result.mac_addr else '-'
+        jedecid = result.jedecid.hex() if result.jedecid else '-'
+        sha = result.sha.hex() if result.sha else '-'
+        print(f"{result.port}: {status} | mac {mac_addr} | jedecid {jedecid}"
+              f" | sha {sha} | {result.elapsed:.2f} s")
+        if result.stats is not None:
+            print(result.stats.summary())
+
+def main():
+    args_parser = ArgsParser()
+    args = args_parser.parse_args()
+
+    if args.debug:
+        config_logging(logging.DEBUG)
+    else:
+        config_logging(logging.INFO)
+
+    # Lets sim:// ports reach simulated MCU
+    bl_url_handlers.register()
+
+    ports = args.ports or [args.port]
+    # Image is mapped once and shared by all workers
+    if args.asyncio:
+        with BLImage(args.firmware) as image:
+            results = asyncio.run(flash_all_async(ports, image, args))
+    else:
+        with BLImage(args.firmware) as image, \
+                ThreadPoolExecutor(max_workers = len(ports)) as executor:
+            results = list(executor.map(
+                lambda port: flash_device(port, image, args), ports))
+
+    if args.stats:
+        print_report(results)
+    else:
+        print_report([result._replace(stats = None) for result in results])
+    if args.statsfile:
+        with open(args.statsfile, 'w') as statsfile:
+            statsfile.write(to_prometheus([result.stats
+                                           for result in results]))
+    failed = sum(result.error is not None for result in results)
+    exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Common fixtures of the test suite.
+
+Tests drive simulated MCU through "sim://" ports (see bl_sim), so no
+hardware is needed. Chip files and bootinfo are found by paths relative to
+repository root, the same way main.py finds them.
+
+"""
+
+import itertools
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bl_url_handlers
+
+EFLASH_LOADER_PATH = 'chips/bl702/image/eflash_loader/eflash_loader_32m.bin'
+FIRMWARE_PATH = 'samples/helloworld/project.bin'
+
+# Simulated devices live as long as the process, every test gets its own
+_device_ids = itertools.count()
+
+bl_url_handlers.register()
+
+
+@pytest.fixture(autouse = True)
+def repo_root(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    return ROOT
+
+
+@pytest.fixture
+def sim_url():
+    """Get URL of fresh simulated MCU with fast flash."""
+
+    return f"sim://test{next(_device_ids)}?time_scale=0.01"
+
+
+@pytest.fixture
+def bl_flasher(sim_url):
+    """Get BLFlasher connected to simulated MCU, eflash loader not started."""
+
+    from bl_flasher import BLFlasher
+    from bl_uart import BLUart
+
+    bl_uart = BLUart(port = sim_url)
+    yield BLFlasher(bl_uart)
+    bl_uart.close()
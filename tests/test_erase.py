@@ -0,0 +1,112 @@
+import functools
+import types
+
+import pytest
+
+from bl_erase import BLErasePlanner
+from bootinfo import BootInfo
+
+KB = 1024
+
+
+def make_flash_cfg(sector = 300, block32K = 1200, block64K = 1200,
+                   chip = 30000):
+    # Same units as SpiFlashCfg, sizes in KB and times in milliseconds
+    return types.SimpleNamespace(sector_size = 4,
+                                 sector_erase_time = sector,
+                                 block32K_erase_time = block32K,
+                                 block64K_erase_time = block64K,
+                                 chip_erase_time = chip)
+
+
+def best_time(planner, start_addr, end_addr):
+    """Find cheapest erase time by trying every aligned tiling."""
+
+    sector_size = planner.sector_size
+    first = start_addr // sector_size
+    last = end_addr // sector_size + 1
+
+    @functools.lru_cache(maxsize = None)
+    def cost(sector):
+        if sector == last:
+            return 0.0
+        best = float('inf')
+        for _, size, time in planner.granularities:
+            span = size // sector_size
+            if (sector * sector_size) % size == 0 and sector + span <= last:
+                best = min(best, time + cost(sector + span))
+        return best
+
+    return cost(first)
+
+
+def test_plan_of_bootinfo_flash_cfg():
+    flash_cfg = BootInfo('utils/bootinfo.cfg').bootheader.flash_cfg.cfg
+    planner = BLErasePlanner(flash_cfg)
+
+    steps, total_time = planner.plan(0x0000, 0x1FFFF)
+
+    assert [step.kind for step in steps] == ['block64K', 'block64K']
+    assert total_time == pytest.approx(sum(step.time for step in steps))
+
+
+@pytest.mark.parametrize('start_addr, end_addr', [
+    (0x0000, 0x0000),
+    (0x1234, 0x1234),
+    (0x2000, 0x2FFFF),
+    (0x1000, 0x20FFF),
+    (0x7FFF, 0x18001),
+    (0x0000, 0x3FFFF),
+])
+def test_steps_are_aligned_and_cover_region(start_addr, end_addr):
+    planner = BLErasePlanner(make_flash_cfg())
+
+    steps, _ = planner.plan(start_addr, end_addr)
+
+    sizes = {kind: size for kind, size, _ in planner.granularities}
+    for step in steps:
+        size = sizes[step.kind]
+        assert step.start_addr % size == 0
+        assert step.end_addr - step.start_addr + 1 == size
+    for prev, step in zip(steps, steps[1:]):
+        assert step.start_addr == prev.end_addr + 1
+    # Extended to whole sectors, not more
+    assert steps[0].start_addr == start_addr - start_addr % (4 * KB)
+    assert steps[-1].end_addr == end_addr - end_addr % (4 * KB) + 4 * KB - 1
+
+
+@pytest.mark.parametrize('flash_cfg', [
+    make_flash_cfg(),
+    make_flash_cfg(sector = 45, block32K = 120, block64K = 150),
+    make_flash_cfg(sector = 100, block32K = 1000, block64K = 5000),
+    make_flash_cfg(sector = 400, block32K = 1000, block64K = 1800),
+])
+@pytest.mark.parametrize('start_addr, end_addr', [
+    (0x0000, 0x0FFF),
+    (0x1000, 0x20FFF),
+    (0x3000, 0x2CFFF),
+    (0x8000, 0x37FFF),
+    (0x0000, 0x4FFFF),
+])
+def test_plan_is_optimal(flash_cfg, start_addr, end_addr):
+    planner = BLErasePlanner(flash_cfg)
+
+    steps, total_time = planner.plan(start_addr, end_addr)
+
+    assert total_time == pytest.approx(best_time(planner, start_addr,
+                                                 end_addr))
+    assert total_time == pytest.approx(sum(step.time for step in steps))
+
+
+def test_chip_erase_only_when_allowed_and_faster():
+    planner = BLErasePlanner(make_flash_cfg(chip = 2000))
+
+    steps, total_time = planner.plan(0x0000, 0x3FFFF)
+    assert 'chip' not in [step.kind for step in steps]
+
+    steps, total_time = planner.plan(0x0000, 0x3FFFF, allow_chip_erase = True)
+    assert [step.kind for step in steps] == ['chip']
+    assert total_time == pytest.approx(2.0)
+
+    steps, _ = planner.plan(0x0000, 0x0FFF, allow_chip_erase = True)
+    assert [step.kind for step in steps] == ['sector']
@@ -0,0 +1,63 @@
+import asyncio
+import hashlib
+
+import bl_sim
+from bl_async_flasher import AsyncBLFlasher
+from bl_async_uart import AsyncBLUart
+from bl_image import BLImage
+from conftest import EFLASH_LOADER_PATH, FIRMWARE_PATH
+
+
+def test_prepare_and_flash_firmware(bl_flasher, sim_url):
+    bl_flasher.prepare(EFLASH_LOADER_PATH, load_baudrate = 2_000_000)
+    assert bl_flasher.bl_uart.baudrate == 2_000_000
+
+    with BLImage(FIRMWARE_PATH) as image:
+        sha = bl_flasher.flash_firmware(image, window = 3)
+        data = bytes(image.data)
+
+    assert sha == hashlib.sha256(data).digest()
+    device = bl_sim.get_device(sim_url)
+    assert device.flash[0x2000:0x2000 + len(data)] == data
+
+
+def test_incremental_flash_skips_unchanged(bl_flasher, caplog):
+    bl_flasher.prepare(EFLASH_LOADER_PATH)
+
+    with BLImage(FIRMWARE_PATH) as image:
+        bl_flasher.flash_firmware(image)
+        caplog.clear()
+        with caplog.at_level('INFO'):
+            sha = bl_flasher.flash_firmware(image, incremental = True)
+        data = bytes(image.data)
+
+    assert sha == hashlib.sha256(data).digest()
+    assert "0 of " in caplog.text
+
+
+def test_reuse_running_loader(bl_flasher):
+    assert bl_flasher.prepare(EFLASH_LOADER_PATH) is not None
+
+    assert bl_flasher.prepare(EFLASH_LOADER_PATH, 2_000_000,
+                              reuse = True) is None
+    assert bl_flasher.bl_uart.baudrate == 2_000_000
+
+
+def test_async_prepare_and_flash_firmware(sim_url):
+    async def flash(data):
+        bl_uart = AsyncBLUart(port = sim_url)
+        try:
+            bl_flasher = AsyncBLFlasher(bl_uart)
+            await bl_flasher.prepare(EFLASH_LOADER_PATH, 2_000_000)
+            return await bl_flasher.flash_firmware(image, window = 3,
+                                                   compress = True)
+        finally:
+            await bl_uart.close()
+
+    with BLImage(FIRMWARE_PATH) as image:
+        sha = asyncio.run(flash(image))
+        data = bytes(image.data)
+
+    assert sha == hashlib.sha256(data).digest()
+    device = bl_sim.get_device(sim_url)
+    assert device.flash[0x2000:0x2000 + len(data)] == data
@@ -0,0 +1,51 @@
+from bl_frame import BLFrameDecoder
+
+
+def test_split_frames_are_joined():
+    decoder = BLFrameDecoder()
+    decoder.expect(with_payload = True)
+    frame = b'OK\x04\x00\xc8\x40\x15\x00'
+
+    frames = []
+    for i in range(len(frame)):
+        frames += decoder.feed(frame[i:i + 1])
+
+    assert frames == [frame]
+
+
+def test_merged_frames_are_split():
+    decoder = BLFrameDecoder()
+    decoder.expect()
+    decoder.expect(with_payload = True)
+    decoder.expect()
+
+    frames = decoder.feed(b'PDOK' + b'OK\x02\x00\xab\xcd' + b'FL\x03\x01')
+
+    assert frames == [b'PD', b'OK', b'OK\x02\x00\xab\xcd', b'FL\x03\x01']
+    assert not decoder.expected
+
+
+def test_payload_split_across_feeds():
+    decoder = BLFrameDecoder()
+    decoder.expect(with_payload = True)
+    decoder.expect()
+
+    assert decoder.feed(b'OK\x03') == []
+    assert decoder.feed(b'\x00abc') == [b'OK\x03\x00abc']
+    assert decoder.feed(b'OK') == [b'OK']
+
+
+def test_pending_doesnt_consume_expected_shape():
+    decoder = BLFrameDecoder()
+    decoder.expect(with_payload = True)
+
+    frames = decoder.feed(b'PDPDOK\x01\x00\x7f')
+
+    assert frames == [b'PD', b'PD', b'OK\x01\x00\x7f']
+
+
+def test_garbage_is_skipped():
+    decoder = BLFrameDecoder()
+    decoder.expect()
+
+    assert decoder.feed(b'\x00\xffOK') == [b'OK']
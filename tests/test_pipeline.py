@@ -0,0 +1,57 @@
+import hashlib
+
+import pytest
+
+import bl_errors
+import bl_sim
+from bl_protocol import BLProtocolBase, max_window_for
+from conftest import EFLASH_LOADER_PATH
+
+
+def test_window_fits_loader_rx_buffer():
+    assert max_window_for(4096) == 3
+    assert max_window_for(8000) == 2
+    assert max_window_for(1024) == 15
+
+
+@pytest.mark.parametrize('window', [1, 3, 8])
+def test_pipelined_write(bl_flasher, sim_url, window):
+    bl_flasher.prepare(EFLASH_LOADER_PATH)
+    data = bytes(range(256)) * 80
+
+    bl_flasher.erase(0x10000, 0x10000 + len(data) - 1)
+    sha = bl_flasher.bl_proto.flash_write_all(0x10000, data, 4096, window)
+
+    assert sha == hashlib.sha256(data).digest()
+    device = bl_sim.get_device(sim_url)
+    assert device.flash[0x10000:0x10000 + len(data)] == data
+
+
+def test_failed_write_keeps_rx_stream_in_sync(bl_flasher, monkeypatch):
+    bl_flasher.prepare(EFLASH_LOADER_PATH)
+    data = bytes(range(256)) * 80
+    bl_flasher.erase(0x10000, 0x10000 + len(data) - 1)
+
+    # Corrupt checksum of the second chunk, the following ones are already
+    # in flight when MCU reports FL
+    calc_checksum = BLProtocolBase.calc_checksum
+    chunks = []
+    def bad_checksum(data):
+        checksum = calc_checksum(data)
+        if len(data) > 1000:
+            chunks.append(data)
+            if len(chunks) == 2:
+                return (checksum + 1) & 0xFF
+        return checksum
+    monkeypatch.setattr(BLProtocolBase, 'calc_checksum',
+                        staticmethod(bad_checksum))
+
+    with pytest.raises(bl_errors.CrcError):
+        bl_flasher.bl_proto.flash_write_all(0x10000, data, 4096, window = 3)
+    assert len(chunks) > 2
+
+    # Responses of commands in flight were collected, next command gets
+    # its own response
+    assert bl_flasher.bl_proto.read_jedecid() == bytes.fromhex('c8401500')
+    sha = bl_flasher.bl_proto.flash_write_all(0x20000, data, 4096, window = 3)
+    assert sha == hashlib.sha256(data).digest()